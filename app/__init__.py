@@ -2,35 +2,118 @@ import ssl
 import os
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
-from dotenv import load_dotenv
 from logging.config import dictConfig
-from flasgger import Swagger
 
-load_dotenv()
+db = SQLAlchemy()
 
-dictConfig({
-    'version': 1,
-    'formatters': {'default': {
-        'format': '[%(asctime)s] %(levelname)s in %(module)s: %(message)s',
-    }}})
 
-if hasattr(ssl, '_create_unverified_context'):
-    ssl._create_default_https_context = ssl._create_unverified_context
+def env_flag(key, default="False"):
+    return os.getenv(key, default).lower() in ('true', '1', 't')
 
-app = Flask(__name__)
-app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("SQLALCHEMY_DATABASE_URI")
-app.config['SWAGGER'] = {
-    'title': 'RSS Scraper API Docs v0.1',
-}
-swagger = Swagger(app)
-db = SQLAlchemy(app)
 
-from app.models.Feed import Feed
-from app.models.Item import Item
+def env_config():
+    """
+    Application settings from environment variables (and .env file)
+    """
+    return {
+        "SQLALCHEMY_DATABASE_URI": os.getenv("SQLALCHEMY_DATABASE_URI"),
+        # Response cache for GET endpoints: none, lru (in-process) or redis
+        "RESPONSE_CACHE": os.getenv("RESPONSE_CACHE", "none"),
+        "RESPONSE_CACHE_URL": os.getenv("RESPONSE_CACHE_URL", "redis://localhost:6379/0"),
+        "RESPONSE_CACHE_TTL_SEC": int(os.getenv("RESPONSE_CACHE_TTL_SEC", 60)),
+        "RESPONSE_CACHE_MAX_SIZE": int(os.getenv("RESPONSE_CACHE_MAX_SIZE", 1024)),
+        # Pooled HTTP client for feed downloads
+        "HTTP_POOL_SIZE": int(os.getenv("HTTP_POOL_SIZE", 32)),
+        "HTTP_TIMEOUT_SEC": int(os.getenv("HTTP_TIMEOUT_SEC", 30)),
+        "HTTP_VERIFY_SSL": env_flag("HTTP_VERIFY_SSL"),
+        # Limits of one feed document and incremental parsing mode
+        "MAX_FEED_BYTES": int(os.getenv("MAX_FEED_BYTES", 10 * 1024 * 1024)),
+        "MAX_FEED_ENTRIES": int(os.getenv("MAX_FEED_ENTRIES", 1000)),
+        "FEED_STREAMING_PARSE": env_flag("FEED_STREAMING_PARSE"),
+        # Bounds of adaptive polling interval of every feed
+        "POLL_MIN_INTERVAL_SEC": int(os.getenv("POLL_MIN_INTERVAL_SEC", 60)),
+        "POLL_MAX_INTERVAL_SEC": int(os.getenv("POLL_MAX_INTERVAL_SEC", 86400)),
+        # Max number of feeds in one bulk import (POST /feeds/import)
+        "FEED_IMPORT_MAX_ROWS": int(os.getenv("FEED_IMPORT_MAX_ROWS", 10000)),
+        # API docs on /apidocs/ (flasgger is imported only if they are enabled)
+        "SWAGGER_ENABLED": env_flag("SWAGGER_ENABLED", "True"),
+        "SWAGGER": {
+            'title': 'RSS Scraper API Docs v0.1',
+        },
+    }
 
-with app.app_context():
-    db.create_all()
 
-from app.views.feeds import get_all_feeds, get_feed_items, follow_feed, unfollow_feed, update_feed, \
-    force_all_feeds_update, force_feed_update
-from app.views.items import set_read, get_all_items
+def create_app(config=None):
+    """
+    Application factory. Nothing is done on import of the package, and creating the app doesn't touch
+    the database: schema is created by a separate command (flask --app wsgi init-db).
+    :param config: Settings which override the ones from environment variables
+    """
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+    dictConfig({
+        'version': 1,
+        'formatters': {'default': {
+            'format': '[%(asctime)s] %(levelname)s in %(module)s: %(message)s',
+        }}})
+
+    if hasattr(ssl, '_create_unverified_context'):
+        ssl._create_default_https_context = ssl._create_unverified_context
+
+    app = Flask(__name__)
+    app.config.update(env_config())
+    app.config.update(config or {})
+    db.init_app(app)
+
+    from app.cache import response_cache
+    from app.http_client import http_client
+    from app import metrics
+
+    response_cache.init_app(app)
+    http_client.init_app(app)
+    metrics.init_app(app)
+
+    # models are registered in db.metadata on import
+    from app.models.Feed import Feed
+    from app.models.Item import Item
+    from app.models.ArchivedItem import ArchivedItem
+    from app.models.ItemAlias import ItemAlias
+    from app.models.Notification import Notification
+    from app.models.HostHealth import HostHealth
+
+    from app.views import feeds, items, cache, metrics as metrics_views
+
+    for module in (feeds, items, cache, metrics_views):
+        app.register_blueprint(module.bp)
+
+    @app.cli.command("init-db")
+    def init_db():
+        """Create database tables, columns and indexes which don't exist yet"""
+        from app.schema import upgrade_schema
+
+        for table, columns in upgrade_schema().items():
+            app.logger.info(f"Columns added to {table}: {', '.join(columns)}")
+        app.logger.info("Database schema is up to date")
+
+    if app.config["SWAGGER_ENABLED"]:
+        from flasgger import Swagger
+
+        Swagger(app)
+    return app
+
+
+_default_app = None
+
+
+def __getattr__(name):
+    """
+    `from app import app` gives the default application, it's created on first use
+    """
+    global _default_app
+    if name == "app":
+        if _default_app is None:
+            _default_app = create_app()
+        return _default_app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,148 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import request, make_response, Response
+
+
+class LRUBackend:
+    """
+    In-process LRU storage. Every process has its own copy, so writes made by another process
+    (e.g. celery worker) are seen only after ttl expires. Use RedisBackend to share invalidation.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        # counters (generation, hits, misses) are kept apart, so they're never evicted
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._counters:
+                return self._counters[key]
+            if key not in self._data:
+                return None
+            value, expires_at = self._data[key]
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl if ttl else None)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+
+class RedisBackend:
+    """
+    Storage in Redis (the same instance as celery broker can be used).
+    Shared between all API processes and workers.
+    """
+
+    def __init__(self, url):
+        import redis
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        value = self.client.get(key)
+        return value.decode() if value is not None else None
+
+    def set(self, key, value, ttl=None):
+        self.client.set(key, value, ex=ttl)
+
+    def incr(self, key):
+        return self.client.incr(key)
+
+
+class ResponseCache:
+    """
+    Read-through cache for GET endpoints.
+    Cache key contains a generation number. Any write which changes feeds or items calls @invalidate,
+    it bumps the generation, so all previously cached responses are not used anymore
+    (and then evicted by LRU or expired by ttl).
+    """
+    prefix = "response-cache"
+
+    def __init__(self):
+        self.backend = None
+        self.ttl = None
+
+    def init_app(self, app):
+        self.configure(app.config.get("RESPONSE_CACHE", "none"),
+                       ttl=app.config.get("RESPONSE_CACHE_TTL_SEC"),
+                       max_size=app.config.get("RESPONSE_CACHE_MAX_SIZE", 1024),
+                       url=app.config.get("RESPONSE_CACHE_URL"))
+
+    def configure(self, backend, ttl=None, max_size=1024, url=None):
+        """
+        :param backend: "lru", "redis" or "none" (cache is turned off)
+        """
+        if backend == "lru":
+            self.backend = LRUBackend(max_size)
+        elif backend == "redis":
+            self.backend = RedisBackend(url)
+        elif backend == "none":
+            self.backend = None
+        else:
+            raise ValueError(f'Invalid response cache backend {backend}')
+        self.ttl = ttl
+
+    def _key(self, name):
+        return f"{self.prefix}:{name}"
+
+    def invalidate(self):
+        if self.backend is not None:
+            self.backend.incr(self._key("generation"))
+
+    def stats(self):
+        if self.backend is None:
+            return {"enabled": False}
+        return {"enabled": True,
+                "hits": int(self.backend.get(self._key("hits")) or 0),
+                "misses": int(self.backend.get(self._key("misses")) or 0)}
+
+    def cached(self, view):
+        """
+        Decorator for GET views. Only successful (200) and not streamed responses are cached
+        """
+
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if self.backend is None:
+                return view(*args, **kwargs)
+            generation = self.backend.get(self._key("generation")) or 0
+            key = self._key(f"{generation}:{request.headers.get('Accept', '')}:{request.full_path}")
+            cached = self.backend.get(key)
+            if cached is not None:
+                self.backend.incr(self._key("hits"))
+                cached = json.loads(cached)
+                response = Response(cached["data"], status=200, mimetype=cached["mimetype"])
+                if cached.get("etag"):
+                    response.set_etag(cached["etag"])
+                return response.make_conditional(request)
+            self.backend.incr(self._key("misses"))
+
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed:
+                self.backend.set(key, json.dumps({"data": response.get_data(as_text=True),
+                                                  "mimetype": response.mimetype,
+                                                  "etag": response.get_etag()[0]}), self.ttl)
+            return response
+
+        return wrapper
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,39 @@
+import hashlib
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+# Query parameters which only track the click and don't change the article
+TRACKING_PARAMS = {"fbclid", "gclid", "dclid", "msclkid", "igshid", "mc_cid", "mc_eid", "_hsenc", "_hsmi", "yclid"}
+TRACKING_PREFIXES = ("utm_",)
+
+
+def is_tracking_param(name):
+    name = name.lower()
+    return name in TRACKING_PARAMS or name.startswith(TRACKING_PREFIXES)
+
+
+def normalize_url(url):
+    """
+    URL of the same article as it's referenced by different feeds: without scheme, fragment, "www.",
+    default port, trailing slash and tracking parameters, with sorted query
+    """
+    parts = urlsplit(url.strip())
+    host = (parts.hostname or "").lower()
+    if host.startswith("www."):
+        host = host[4:]
+    if parts.port and parts.port not in (80, 443):
+        host = f"{host}:{parts.port}"
+    path = parts.path.rstrip("/") or "/"
+    query = urlencode(sorted((name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True)
+                             if not is_tracking_param(name)))
+    return f"{host}{path}?{query}" if query else f"{host}{path}"
+
+
+def normalize_title(title):
+    return " ".join(title.split()).casefold()
+
+
+def item_fingerprint(url, title):
+    """
+    :return: sha1 hex digest of normalized url and title, the same for one article in different feeds
+    """
+    return hashlib.sha1(f"{normalize_url(url)}\n{normalize_title(title)}".encode()).hexdigest()
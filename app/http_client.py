@@ -0,0 +1,64 @@
+import os
+import threading
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+
+class HTTPClient:
+    """
+    Shared HTTP client for feed downloads: keep-alive connection pool (connections to the same host are reused
+    between fetches) and gzip/deflate compression.
+
+    Session is created lazily and recreated when process id changes, so every celery prefork child
+    gets its own pool instead of sockets inherited from the parent process.
+    """
+
+    def __init__(self):
+        self.pool_size = 32
+        self.timeout = 30
+        self.verify_ssl = True
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.configure(app.config.get("HTTP_POOL_SIZE", 32), app.config.get("HTTP_TIMEOUT_SEC", 30),
+                       app.config.get("HTTP_VERIFY_SSL", True))
+
+    def configure(self, pool_size, timeout, verify_ssl=True):
+        """
+        :param pool_size: Max kept-alive connections per host (and number of hosts with kept-alive connections).
+                          Should be not less than fetch concurrency of the worker
+        :param timeout: Connect and read timeout in seconds
+        """
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.verify_ssl = verify_ssl
+        self._session = None
+        if not verify_ssl:
+            urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+    @property
+    def session(self):
+        with self._lock:
+            if self._session is None or self._pid != os.getpid():
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                session.headers["Accept-Encoding"] = "gzip, deflate"
+                session.verify = self.verify_ssl
+                self._session = session
+                self._pid = os.getpid()
+            return self._session
+
+    def get(self, url, headers=None, stream=False):
+        """
+        :param stream: If True - body is not read here (use response.iter_content and close the response)
+        """
+        return self.session.get(url, headers=headers, timeout=self.timeout, stream=stream)
+
+
+http_client = HTTPClient()
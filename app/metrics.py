@@ -0,0 +1,56 @@
+import os
+import time
+
+from flask import g, request, Response
+from prometheus_client import CollectorRegistry, Counter, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client import multiprocess
+
+# Labels are bounded on purpose: there are no per feed or per url labels,
+# per feed numbers are distributions (histograms) over all feeds
+FEED_FETCH_SECONDS = Histogram("rss_feed_fetch_seconds", "Feed fetch time (download and parse)", ["status"])
+FEED_FETCH_BYTES = Counter("rss_feed_fetch_bytes_total", "Downloaded bytes of feed documents")
+FEED_PARSE_SECONDS = Histogram("rss_feed_parse_seconds", "Feed parse time (includes download in streaming mode)")
+FEED_DB_SECONDS = Histogram("rss_feed_db_seconds", "Time of saving one feed update to the database")
+FEED_ENTRIES = Counter("rss_feed_entries_total", "Entries of fetched feeds by result", ["result"])
+FEED_NEW_ENTRIES = Histogram("rss_feed_new_entries", "New entries per feed update",
+                             buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+SWEEP_SECONDS = Histogram("rss_sweep_duration_seconds", "Duration of one background update sweep",
+                          buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600))
+SWEEP_FEEDS = Counter("rss_sweep_feeds_total", "Feeds processed by background update by result", ["result"])
+QUEUE_LAG_SECONDS = Histogram("rss_feed_queue_lag_seconds", "Delay between feed becoming due and its update start",
+                              buckets=(0.1, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600))
+HTTP_REQUEST_SECONDS = Histogram("rss_http_request_duration_seconds", "API request latency",
+                                 ["method", "endpoint", "status"])
+
+
+def registry():
+    """
+    With PROMETHEUS_MULTIPROC_DIR (uwsgi workers, celery prefork children) metrics of all processes are merged
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        merged = CollectorRegistry()
+        multiprocess.MultiProcessCollector(merged)
+        return merged
+    return REGISTRY
+
+
+def metrics_response():
+    return Response(generate_latest(registry()), mimetype=CONTENT_TYPE_LATEST)
+
+
+def init_app(app):
+    """
+    Request latency of every view, labeled by url rule (not by actual path, so the number of series is bounded)
+    """
+
+    @app.before_request
+    def start_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def observe_latency(response):
+        if "request_started" in g:
+            endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+            HTTP_REQUEST_SECONDS.labels(request.method, endpoint, response.status_code).observe(
+                time.perf_counter() - g.request_started)
+        return response
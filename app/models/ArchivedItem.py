@@ -0,0 +1,35 @@
+from dataclasses import dataclass
+from datetime import datetime
+from sqlalchemy_serializer import SerializerMixin
+
+from app import db
+
+
+@dataclass
+class ArchivedItem(db.Model, SerializerMixin):
+    """
+    Items moved out of the item table by retention (see app.utils.archive_items).
+    Same columns as Item without unique constraints, ids are kept
+    """
+    serialize_rules = ('-remote_id', '-change_seq', '-published_at', '-created_at', '-fingerprint')
+    __table_args__ = (
+        # dedup of incoming entries in update_feed, archived entries aren't inserted again
+        db.Index("ix_archived_item_feed_id_remote_id", "feed_id", "remote_id"),
+        # listings ETag
+        db.Index("ix_archived_item_archived_at", "archived_at"),
+        # dedup of the same article from another feed (see app.utils.link_duplicates)
+        db.Index("ix_archived_item_fingerprint", "fingerprint"),
+    )
+
+    feed_id = db.Column(db.Integer, db.ForeignKey('feed.id'), nullable=False)
+    id = db.Column("id", db.Integer, primary_key=True, autoincrement=False)
+    title = db.Column(db.String, nullable=False)
+    url = db.Column(db.String, nullable=False)
+    last_updated = db.Column(db.DateTime)
+    unread = db.Column(db.Boolean, nullable=False)
+    remote_id = db.Column(db.String, nullable=False)
+    change_seq = db.Column(db.BigInteger, nullable=True)
+    published_at = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=True)
+    fingerprint = db.Column(db.String(40), nullable=True)
+    archived_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
@@ -1,5 +1,6 @@
 from dataclasses import dataclass
-from datetime import datetime
+from datetime import datetime, timedelta
+from sqlalchemy import or_
 from sqlalchemy_serializer import SerializerMixin
 
 from app import db
@@ -7,7 +8,15 @@ from app import db
 
 @dataclass
 class Feed(db.Model, SerializerMixin):
-    serialize_rules = ('-items',)
+    serialize_rules = ('-items', '-etag', '-modified', '-poll_interval_sec', '-lease_owner', '-lease_expires_at',
+                       '-high_water_mark', '-retention_max_age_days', '-retention_max_items',
+                       '-next_retry_at')
+    __table_args__ = (
+        # due feeds lookup in the background update
+        db.Index("ix_feed_active_next_poll_at", "active", "next_poll_at"),
+    )
+    # How many newest entries are used to estimate publish frequency
+    poll_sample_size = 10
 
     id = db.Column("id", db.Integer, primary_key=True)
     name = db.Column(db.String, unique=True, nullable=False)
@@ -17,6 +26,22 @@ class Feed(db.Model, SerializerMixin):
     active = db.Column(db.Boolean, nullable=False, default=True, server_default=db.true())
     errors_count = db.Column(db.Integer, server_default='0', nullable=False)
     owner_email = db.Column(db.String, unique=False, nullable=True)
+    # HTTP validators from the last fetch, used for conditional GET
+    etag = db.Column(db.String, nullable=True)
+    modified = db.Column(db.String, nullable=True)
+    # Adaptive polling: when feed should be fetched next time (NULL - as soon as possible)
+    next_poll_at = db.Column(db.DateTime, nullable=True)
+    poll_interval_sec = db.Column(db.Integer, nullable=True)
+    # Publish time of the newest entry we have, older entries are skipped (see app.utils.newer_entries)
+    high_water_mark = db.Column(db.DateTime, nullable=True)
+    # Failed feed isn't claimed before this time (exponential backoff with jitter, see worker.tasks.retry_fail_feed)
+    next_retry_at = db.Column(db.DateTime, nullable=True)
+    # Which worker is updating the feed now and until when (expired lease can be claimed by another worker)
+    lease_owner = db.Column(db.String, nullable=True)
+    lease_expires_at = db.Column(db.DateTime, nullable=True)
+    # Retention of this feed items (NULL - global policy, 0 - keep everything), see app.utils.archive_items
+    retention_max_age_days = db.Column(db.Integer, nullable=True)
+    retention_max_items = db.Column(db.Integer, nullable=True)
 
     def __init__(self, name, url, owner_email=None):
         self.name = name
@@ -24,6 +49,74 @@ class Feed(db.Model, SerializerMixin):
         if owner_email:
             self.owner_email = owner_email
 
+    @classmethod
+    def claim_due(cls, owner, limit, lease_sec):
+        """
+        Claims a batch of due active feeds (from the most overdue) for the worker, so several workers
+        can share the background update without fetching the same feeds.
+        On PostgreSQL rows are selected with FOR UPDATE SKIP LOCKED, so concurrent claims never wait
+        for each other and never get the same feed. Feeds with unexpired lease of another worker are skipped,
+        lease of a crashed worker expires in lease_sec and the feed is claimed again.
+        Failed feeds wait for their next_retry_at.
+        :return: list of claimed feeds (detached from session)
+        """
+        now = datetime.utcnow()
+        feeds = cls.query.filter(
+            cls.active.is_(True),
+            or_(cls.next_poll_at.is_(None), cls.next_poll_at <= now),
+            or_(cls.lease_expires_at.is_(None), cls.lease_expires_at <= now),
+            or_(cls.next_retry_at.is_(None), cls.next_retry_at <= now),
+        ).order_by(cls.next_poll_at.asc().nulls_first()).limit(limit).with_for_update(skip_locked=True).all()
+        if not feeds:
+            db.session.commit()
+            return []
+        for feed in feeds:
+            db.session.expunge(feed)
+        cls.query.filter(cls.id.in_([feed.id for feed in feeds])).update(
+            {cls.lease_owner: owner, cls.lease_expires_at: now + timedelta(seconds=lease_sec)},
+            synchronize_session=False)
+        db.session.commit()
+        return feeds
+
+    @classmethod
+    def renew_leases(cls, feed_ids, owner, lease_sec):
+        """
+        Extends lease of the feeds which are still owned by the worker, so feeds waiting in a long batch
+        aren't claimed by another worker
+        """
+        cls.query.filter(cls.id.in_(feed_ids), cls.lease_owner == owner).update(
+            {cls.lease_expires_at: datetime.utcnow() + timedelta(seconds=lease_sec)}, synchronize_session=False)
+        db.session.commit()
+
+    @classmethod
+    def release_leases(cls, feed_ids, owner):
+        cls.query.filter(cls.id.in_(feed_ids), cls.lease_owner == owner).update(
+            {cls.lease_owner: None, cls.lease_expires_at: None}, synchronize_session=False)
+        db.session.commit()
+
     def touch(self):
         self.last_updated = datetime.utcnow()
         db.session.commit()
+
+    def schedule_next_poll(self, entry_times, has_new, min_interval, max_interval):
+        """
+        Sets next_poll_at by observed publish frequency of the feed.
+        :param entry_times: Publish datetimes of feed entries (can be empty if feed has no dates or wasn't modified)
+        :param has_new: Were there new items in this update
+        :param min_interval: Lower bound of interval in seconds
+        :param max_interval: Upper bound of interval in seconds
+
+        If there are dates - interval is the mean gap between the newest entries, but not less than
+        half of the time since the newest entry (so feeds which were busy long ago are polled rarely).
+        Without dates interval is halved when there were new items and doubled otherwise.
+        """
+        now = datetime.utcnow()
+        entry_times = sorted(entry_times, reverse=True)[:self.poll_sample_size]
+        if len(entry_times) >= 2:
+            mean_gap = (entry_times[0] - entry_times[-1]).total_seconds() / (len(entry_times) - 1)
+            interval = max(mean_gap, (now - entry_times[0]).total_seconds() / 2)
+        else:
+            previous = self.poll_interval_sec or min_interval
+            interval = previous / 2 if has_new else previous * 2
+        self.poll_interval_sec = int(min(max(interval, min_interval), max_interval))
+        self.next_poll_at = now + timedelta(seconds=self.poll_interval_sec)
@@ -0,0 +1,59 @@
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy_serializer import SerializerMixin
+
+from app import db
+
+
+@dataclass
+class HostHealth(db.Model, SerializerMixin):
+    """
+    Circuit breaker of feed hosts. After threshold consecutive failed fetches the circuit of the host opens:
+    its feeds aren't fetched (and their errors aren't counted) until opened_until. The first fetch after that
+    either closes the circuit or opens it again for twice as long.
+    Only hosts which have failed have rows.
+    """
+    host = db.Column(db.String, primary_key=True)
+    consecutive_failures = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    last_failure_at = db.Column(db.DateTime, nullable=True)
+    opened_until = db.Column(db.DateTime, nullable=True)
+
+    @classmethod
+    def failing(cls, hosts):
+        """
+        :return: dict host -> opened_until (None if circuit is closed) of the given hosts which have failures
+        """
+        if not hosts:
+            return {}
+        return dict(db.session.query(cls.host, cls.opened_until).filter(
+            cls.host.in_(hosts), cls.consecutive_failures > 0))
+
+    @classmethod
+    def record_failure(cls, host, threshold, open_sec, max_open_sec):
+        """
+        :return: opened_until of the host (None if circuit is still closed)
+        """
+        now = datetime.utcnow()
+        updated = cls.query.filter_by(host=host).update(
+            {cls.consecutive_failures: cls.consecutive_failures + 1, cls.last_failure_at: now},
+            synchronize_session=False)
+        if not updated:
+            db.session.add(cls(host=host, consecutive_failures=1, last_failure_at=now))
+            try:
+                db.session.flush()
+            except IntegrityError:
+                # another worker has recorded the first failure of the host at the same time
+                db.session.rollback()
+                return cls.record_failure(host, threshold, open_sec, max_open_sec)
+        health = db.session.get(cls, host, populate_existing=True)
+        if health.consecutive_failures >= threshold:
+            health.opened_until = now + timedelta(
+                seconds=min(open_sec * 2 ** (health.consecutive_failures - threshold), max_open_sec))
+        db.session.commit()
+        return health.opened_until
+
+    @classmethod
+    def record_success(cls, host):
+        cls.query.filter_by(host=host).delete(synchronize_session=False)
+        db.session.commit()
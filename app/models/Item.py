@@ -1,13 +1,67 @@
 from dataclasses import dataclass
 from datetime import datetime
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
 from sqlalchemy_serializer import SerializerMixin
 
 from app import db
 
+# Source of Item.change_seq on PostgreSQL (it's not created on SQLite, see next_change_seq)
+item_change_seq = db.Sequence("item_change_seq", metadata=db.metadata)
+# Key of the transaction advisory lock which is taken with every change_seq on PostgreSQL
+CHANGE_SEQ_LOCK_KEY = 7264401
+
+# Sequence values are given in call order, but transactions commit in another order, and a client which polled
+# between the commits would move its cursor past the lower value and never see its row. So the value is taken
+# under a transaction level lock: the next transaction changing items waits for this one to commit,
+# and change_seq order is the commit order. Keep transactions which change items short.
+change_seq_function_ddl = f"""
+CREATE OR REPLACE FUNCTION item_next_change_seq() RETURNS bigint LANGUAGE sql VOLATILE AS $$
+    SELECT pg_advisory_xact_lock({CHANGE_SEQ_LOCK_KEY});
+    SELECT nextval('item_change_seq');
+$$
+"""
+
+
+class next_change_seq(FunctionElement):
+    """
+    Default and onupdate value of Item.change_seq: monotonic number of the change, which is used
+    as a cursor of the change feed. It's a SQL expression rendered into the INSERT/UPDATE statement itself,
+    so bulk inserts don't make an extra query per row.
+    PostgreSQL takes it from a sequence by item_next_change_seq(), SQLite (single writer) - as max + 1
+    """
+    type = db.BigInteger()
+    inherit_cache = True
+
+
+@compiles(next_change_seq)
+def compile_next_change_seq(element, compiler, **kw):
+    return "(SELECT coalesce(max(change_seq), 0) + 1 FROM item)"
+
+
+@compiles(next_change_seq, "postgresql")
+def compile_next_change_seq_postgresql(element, compiler, **kw):
+    return "item_next_change_seq()"
+
 
 @dataclass
 class Item(db.Model, SerializerMixin):
-    serialize_rules = ('-remote_id', )
+    serialize_rules = ('-remote_id', '-change_seq', '-fingerprint', '-published_at', '-created_at')
+    __table_args__ = (
+        # dedup of incoming entries in update_feed
+        db.Index("ix_item_feed_id_remote_id", "feed_id", "remote_id"),
+        # keyset pagination of listings, ordered by (last_updated, id)
+        db.Index("ix_item_feed_id_unread_last_updated", "feed_id", "unread", "last_updated", "id"),
+        db.Index("ix_item_feed_id_last_updated", "feed_id", "last_updated", "id"),
+        db.Index("ix_item_unread_last_updated", "unread", "last_updated", "id"),
+        db.Index("ix_item_last_updated", "last_updated", "id"),
+        # change feed (GET /items/changes) and listings ETag
+        db.Index("ix_item_change_seq", "change_seq", "id"),
+        # high water mark of feeds without one (see app.utils.newer_entries)
+        db.Index("ix_item_feed_id_published_at", "feed_id", "published_at"),
+        # retention by storing time (see app.utils.expired_items_filter)
+        db.Index("ix_item_feed_id_created_at", "feed_id", "created_at", "id"),
+    )
 
     feed_id = db.Column(db.Integer, db.ForeignKey('feed.id'), nullable=False)
     id = db.Column("id", db.Integer, primary_key=True)
@@ -16,8 +70,42 @@ class Item(db.Model, SerializerMixin):
     last_updated = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     unread = db.Column(db.Boolean, nullable=False, default=True, server_default=db.true())
     remote_id = db.Column(db.String, unique=True, nullable=False)
+    change_seq = db.Column(db.BigInteger, nullable=True, default=next_change_seq(), onupdate=next_change_seq())
+    # Publish (or update) time of the entry from the feed, NULL if feed has no dates
+    published_at = db.Column(db.DateTime, nullable=True)
+    # Hash of normalized url and title (see app.fingerprint), duplicates from other feeds are linked by ItemAlias
+    fingerprint = db.Column(db.String(40), unique=True, nullable=True)
+    # When the item was stored, unlike last_updated it doesn't change when the item is read
+    created_at = db.Column(db.DateTime, nullable=True, default=datetime.utcnow)
 
     def __init__(self, title, url, remote_id):
         self.title = title
         self.url = url
         self.remote_id = remote_id
+
+
+# Schema outside of the ORM model, every statement is idempotent (it's run again by app.schema.upgrade_schema).
+# Full-text search over titles (see app.utils.search_items):
+# PostgreSQL - generated tsvector column with GIN index, SQLite - FTS5 external content table kept by triggers
+item_ddl = {
+    "postgresql": [
+        change_seq_function_ddl,
+        "ALTER TABLE item ADD COLUMN IF NOT EXISTS search_vector tsvector "
+        "GENERATED ALWAYS AS (to_tsvector('simple', coalesce(title, ''))) STORED",
+        "CREATE INDEX IF NOT EXISTS ix_item_search_vector ON item USING GIN (search_vector)",
+    ],
+    "sqlite": [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS item_fts USING fts5(title, content='item', content_rowid='id')",
+        "CREATE TRIGGER IF NOT EXISTS item_fts_insert AFTER INSERT ON item BEGIN "
+        "INSERT INTO item_fts(rowid, title) VALUES (new.id, new.title); END",
+        "CREATE TRIGGER IF NOT EXISTS item_fts_delete AFTER DELETE ON item BEGIN "
+        "INSERT INTO item_fts(item_fts, rowid, title) VALUES ('delete', old.id, old.title); END",
+        "CREATE TRIGGER IF NOT EXISTS item_fts_update AFTER UPDATE OF title ON item BEGIN "
+        "INSERT INTO item_fts(item_fts, rowid, title) VALUES ('delete', old.id, old.title); "
+        "INSERT INTO item_fts(rowid, title) VALUES (new.id, new.title); END",
+    ],
+}
+for dialect, statements in item_ddl.items():
+    for statement in statements:
+        db.event.listen(Item.__table__, "after_create", db.DDL(statement).execute_if(dialect=dialect))
+db.event.listen(Item.__table__, "before_drop", db.DDL("DROP TABLE IF EXISTS item_fts").execute_if(dialect="sqlite"))
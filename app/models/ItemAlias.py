@@ -0,0 +1,23 @@
+from dataclasses import dataclass
+from sqlalchemy_serializer import SerializerMixin
+
+from app import db
+
+
+@dataclass
+class ItemAlias(db.Model, SerializerMixin):
+    """
+    Entry of a feed which is a duplicate of an already stored item (the same fingerprint,
+    see app.fingerprint): it's linked to that item instead of being stored again.
+    item_id isn't a foreign key, the item can be moved to archived_item with the same id
+    """
+    __table_args__ = (
+        # dedup of incoming entries in update_feed
+        db.UniqueConstraint("feed_id", "remote_id", name="uq_item_alias_feed_id_remote_id"),
+        db.Index("ix_item_alias_item_id", "item_id"),
+    )
+
+    id = db.Column("id", db.Integer, primary_key=True)
+    feed_id = db.Column(db.Integer, db.ForeignKey('feed.id'), nullable=False)
+    remote_id = db.Column(db.String, nullable=False)
+    item_id = db.Column(db.Integer, nullable=False)
@@ -0,0 +1,46 @@
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from sqlalchemy import or_
+from sqlalchemy_serializer import SerializerMixin
+
+from app import db
+
+
+@dataclass
+class Notification(db.Model, SerializerMixin):
+    """
+    Outbox of notifications. Rows are written in the same transaction as the event they are about
+    (e.g. feed deactivation) and are sent by a separate task, so the feed update never waits for SMTP.
+    dedup_key is unique: the same event enqueued twice (retried sweep, two workers) is sent once.
+    """
+    __table_args__ = (
+        # pending notifications lookup in the drain task
+        db.Index("ix_notification_sent_at_next_attempt_at", "sent_at", "next_attempt_at"),
+    )
+
+    id = db.Column("id", db.Integer, primary_key=True)
+    dedup_key = db.Column(db.String, unique=True, nullable=False)
+    recipient = db.Column(db.String, nullable=False)
+    message = db.Column(db.String, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime, nullable=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    next_attempt_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.String, nullable=True)
+
+    @classmethod
+    def claim_ready(cls, limit, max_attempts, digest_window):
+        """
+        Locks a batch of pending notifications (FOR UPDATE SKIP LOCKED on PostgreSQL, so concurrent
+        drains don't send the same rows). Notifications of a recipient are ready when the oldest of them is
+        older than digest_window seconds, so they can be sent as one digest.
+        Failed notifications are retried at next_attempt_at until they have max_attempts attempts.
+        :return: list of notifications, locked until the end of the transaction
+        """
+        now = datetime.utcnow()
+        pending = (cls.sent_at.is_(None), cls.attempts < max_attempts,
+                   or_(cls.next_attempt_at.is_(None), cls.next_attempt_at <= now))
+        ready_recipients = db.select(cls.recipient).where(*pending).group_by(cls.recipient).having(
+            db.func.min(cls.created_at) <= now - timedelta(seconds=digest_window))
+        return cls.query.filter(*pending, cls.recipient.in_(ready_recipients)).order_by(cls.id).limit(
+            limit).with_for_update(skip_locked=True).all()
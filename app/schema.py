@@ -0,0 +1,107 @@
+"""
+Schema of existing databases (flask --app wsgi init-db)
+"""
+from sqlalchemy import bindparam, text
+from sqlalchemy.schema import CreateColumn
+
+from app import db
+from app.fingerprint import item_fingerprint
+
+# Rows per one batch of the fingerprint backfill
+BACKFILL_BATCH_SIZE = 1000
+
+
+def add_missing_columns(connection, table):
+    """
+    Adds columns of the model which the existing table doesn't have. They are all nullable (or have
+    a server default), so existing rows stay valid. Unique columns get a unique index instead of a constraint
+    (SQLite can't add a UNIQUE column).
+    :return: Names of added columns
+    """
+    preparer = connection.dialect.identifier_preparer
+    existing = {column["name"] for column in db.inspect(connection).get_columns(table.name)}
+    added = []
+    for column in table.columns:
+        if column.name in existing:
+            continue
+        connection.execute(text(f"ALTER TABLE {preparer.format_table(table)} "
+                                f"ADD COLUMN {CreateColumn(column).compile(dialect=connection.dialect)}"))
+        if column.unique:
+            connection.execute(text(f"CREATE UNIQUE INDEX IF NOT EXISTS uq_{table.name}_{column.name} "
+                                    f"ON {preparer.format_table(table)} ({preparer.quote(column.name)})"))
+        added.append(column.name)
+    return added
+
+
+def backfill_fingerprints(connection, table_name, unique):
+    """
+    Fingerprints (see app.fingerprint) of rows stored before the column existed, so the same article
+    from another feed is linked to them. Rows are read by batches in id order
+    :param unique: If True, a row whose fingerprint is already taken (the same article stored twice before
+                   the upgrade) keeps NULL, the first stored one gets it
+    """
+    last_id = 0
+    while True:
+        rows = connection.execute(text(
+            f"SELECT id, url, title FROM {table_name} WHERE fingerprint IS NULL AND id > :last_id "
+            f"ORDER BY id LIMIT {BACKFILL_BATCH_SIZE}"), {"last_id": last_id}).all()
+        if not rows:
+            return
+        last_id = rows[-1].id
+        fingerprints = {row.id: item_fingerprint(row.url, row.title) for row in rows}
+        if unique:
+            stored = text(f"SELECT fingerprint FROM {table_name} WHERE fingerprint IN :fingerprints").bindparams(
+                bindparam("fingerprints", expanding=True))
+            taken = set(connection.execute(stored, {"fingerprints": list(set(fingerprints.values()))}).scalars())
+            for row_id, fingerprint in list(fingerprints.items()):
+                if fingerprint in taken:
+                    del fingerprints[row_id]
+                taken.add(fingerprint)
+        if fingerprints:
+            # plain SQL: no onupdate of the model, the article itself isn't changed
+            connection.execute(text(f"UPDATE {table_name} SET fingerprint = :fingerprint WHERE id = :id"),
+                               [{"id": row_id, "fingerprint": value} for row_id, value in fingerprints.items()])
+
+
+def upgrade_schema():
+    """
+    db.create_all() creates missing tables only. Here tables of an existing database are brought up
+    to the models: missing columns and indexes are added, schema outside of the ORM (see Item.item_ddl)
+    is created again and new columns of existing rows are filled (fingerprints, change_seq, created_at).
+    Only additions are handled: renamed, dropped or retyped columns need a manual migration.
+    :return: dict table -> names of added columns
+    """
+    from app.models.Item import item_ddl
+
+    added = {}
+    with db.engine.begin() as connection:
+        dialect = connection.dialect.name
+        existing_tables = set(db.inspect(connection).get_table_names())
+        db.metadata.create_all(connection)
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            columns = add_missing_columns(connection, table)
+            if columns:
+                added[table.name] = columns
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+
+        if "item" in existing_tables:
+            for statement in item_ddl.get(dialect, []):
+                connection.execute(db.DDL(statement))
+            if dialect == "sqlite" and "item_fts" not in existing_tables:
+                # search index of the items which were stored before it existed
+                connection.execute(text("INSERT INTO item_fts(item_fts) VALUES ('rebuild')"))
+            # retention age of items stored before created_at existed (plain SQL: no onupdate of the model)
+            connection.execute(text("UPDATE item SET created_at = last_updated WHERE created_at IS NULL"))
+            backfill_fingerprints(connection, "item", unique=True)
+            # items stored before change_seq existed are in the change feed too, after the numbered ones
+            if dialect == "postgresql":
+                connection.execute(text("UPDATE item SET change_seq = item_next_change_seq() WHERE change_seq IS NULL"))
+            else:
+                connection.execute(text("UPDATE item SET change_seq = (SELECT coalesce(max(change_seq), 0) FROM item) "
+                                        "+ id WHERE change_seq IS NULL"))
+        if "archived_item" in existing_tables:
+            backfill_fingerprints(connection, "archived_item", unique=False)
+    return added
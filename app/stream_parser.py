@@ -0,0 +1,107 @@
+from datetime import datetime
+from xml.etree.ElementTree import XMLPullParser
+
+from feedparser import FeedParserDict
+from feedparser.datetimes import _parse_date
+
+# Chunk size of the downloaded body
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class FeedTooLarge(Exception):
+    pass
+
+
+def read_limited(response, max_bytes, received):
+    """
+    Reads streamed HTTP response by chunks.
+    :param max_bytes: Max size of the (decompressed) body
+    :param received: List where all read chunks are collected
+    :raise FeedTooLarge: as soon as body exceeds max_bytes
+    """
+    size = 0
+    for chunk in response.iter_content(READ_CHUNK_SIZE):
+        size += len(chunk)
+        if size > max_bytes:
+            raise FeedTooLarge(f"Feed {response.url} is larger than {max_bytes} bytes")
+        received.append(chunk)
+        yield chunk
+
+
+def local_name(tag):
+    return tag.rsplit("}", 1)[-1].lower()
+
+
+def element_text(element):
+    return "".join(element.itertext()).strip()
+
+
+def parse_entry(element):
+    """
+    Takes the same fields of RSS item or Atom entry as update_feed uses from feedparser result
+    """
+    entry = FeedParserDict()
+    for child in element:
+        name = local_name(child.tag)
+        if name in ("guid", "id"):
+            entry["id"] = element_text(child)
+        elif name == "title":
+            entry["title"] = element_text(child)
+        elif name == "link":
+            href = child.get("href")
+            if href is None:
+                entry["link"] = element_text(child)
+            elif child.get("rel", "alternate") == "alternate" and "link" not in entry:
+                entry["link"] = href
+        elif name in ("pubdate", "published", "issued"):
+            entry["published_parsed"] = _parse_date(element_text(child))
+        elif name in ("updated", "modified", "date"):
+            entry["updated_parsed"] = _parse_date(element_text(child))
+    if "id" not in entry and "link" in entry:
+        entry["id"] = entry["link"]
+    return entry
+
+
+def parse_stream(chunks, high_water_mark=None, max_entries=None):
+    """
+    Incremental parser of RSS and Atom feeds. Entries are parsed one by one while the document is downloading,
+    every parsed entry is removed from the tree, so memory doesn't depend on the document size.
+    Parsing (and downloading) stops at the first entry published at or before high_water_mark
+    (feeds list entries from newest to oldest, so the rest are already stored) or after max_entries entries.
+
+    :param chunks: Iterable of document bytes chunks
+    :param high_water_mark: Naive UTC datetime of the newest entry we already have
+    :param max_entries: Max number of entries to parse
+    :return: FeedParserDict with entries (id, title, link, published_parsed, updated_parsed),
+             "truncated" is True if parsing was stopped before the end of the document
+    :raise xml.etree.ElementTree.ParseError: if document is not well-formed XML
+    """
+    result = FeedParserDict(bozo=False, entries=[], truncated=False, feed=FeedParserDict())
+    parser = XMLPullParser(events=("start", "end"))
+    stack = []
+    for chunk in chunks:
+        parser.feed(chunk)
+        for event, element in parser.read_events():
+            if event == "start":
+                stack.append(element)
+                continue
+            stack.pop()
+            name = local_name(element.tag)
+            if name not in ("item", "entry"):
+                if name == "title" and stack and local_name(stack[-1].tag) in ("channel", "feed"):
+                    result.feed["title"] = element_text(element)
+                continue
+
+            entry = parse_entry(element)
+            if stack:
+                stack[-1].remove(element)
+            published = entry.get("published_parsed") or entry.get("updated_parsed")
+            if high_water_mark and published and datetime(*published[:6]) <= high_water_mark:
+                result["truncated"] = True
+                return result
+            result.entries.append(entry)
+            if max_entries and len(result.entries) >= max_entries:
+                result["truncated"] = True
+                return result
+    parser.close()
+    return result
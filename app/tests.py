@@ -1,7 +1,22 @@
 from app import app as flask_app
-from app import db
+from app import create_app, db
 from app.models.Feed import Feed
 from app.models.Item import Item
+from app.models.ArchivedItem import ArchivedItem
+from app.models.ItemAlias import ItemAlias
+from app.fingerprint import item_fingerprint, normalize_url
+from app.serializer import serialize_rows, serialized_columns
+import app.serializer as serializer
+from app.utils import update_feed, archive_items
+import app.utils as app_utils
+from app.cache import response_cache
+from app.stream_parser import parse_stream, FeedTooLarge
+from unittest.mock import patch
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql
+from datetime import datetime, timedelta
+import feedparser
+import requests
 import pytest, json
 
 test_feed = {"name": "feedburner",
@@ -17,6 +32,29 @@ test_item2 = {"title": " Nederlandse regering breidt exportverbod voor ASML-duv-
               "remote_id": "https://tweakers.net/nieuws/207427"
               }
 
+test_rss = """<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0"><channel>
+<title>Tweakers</title>
+<link>https://tweakers.net/</link>
+<lastBuildDate>Mon, 13 Mar 2023 10:00:00 GMT</lastBuildDate>
+<item>
+<title>{title2}</title><link>{url2}</link><guid>{remote_id2}</guid>
+<pubDate>Mon, 13 Mar 2023 09:00:00 GMT</pubDate>
+</item>
+<item>
+<title>{title1}</title><link>{url1}</link><guid>{remote_id1}</guid>
+<pubDate>Mon, 13 Mar 2023 08:00:00 GMT</pubDate>
+</item>
+</channel></rss>
+""".format(**{k + "1": v for k, v in test_item1.items()}, **{k + "2": v for k, v in test_item2.items()})
+
+
+def parsed_rss():
+    feedparsed = feedparser.parse(test_rss)
+    feedparsed["status"] = 200
+    feedparsed["modified"] = "Mon, 13 Mar 2023 10:00:00 GMT"
+    return feedparsed
+
 
 @pytest.fixture()
 def app():
@@ -43,6 +81,58 @@ def runner(app):
     return app.test_cli_runner()
 
 
+def test_create_app_doesnt_touch_database():
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite://", "SWAGGER_ENABLED": False})
+    assert "flasgger" not in app.blueprints
+    with app.app_context():
+        assert not db.inspect(db.engine).get_table_names()
+    result = app.test_cli_runner().invoke(args=["init-db"])
+    assert result.exit_code == 0
+    with app.app_context():
+        assert {"feed", "item"} <= set(db.inspect(db.engine).get_table_names())
+
+
+def test_init_db_upgrades_schema(tmp_path):
+    app = create_app({"SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path}/old.db", "SWAGGER_ENABLED": False})
+    # tables as the first release created them
+    with app.app_context(), db.engine.begin() as connection:
+        for statement in (
+                "CREATE TABLE feed (id INTEGER PRIMARY KEY, name VARCHAR NOT NULL UNIQUE, url VARCHAR NOT NULL UNIQUE, "
+                "last_updated DATETIME, active BOOLEAN DEFAULT 1 NOT NULL, errors_count INTEGER DEFAULT '0' NOT NULL, "
+                "owner_email VARCHAR)",
+                "CREATE TABLE item (feed_id INTEGER NOT NULL REFERENCES feed (id), id INTEGER PRIMARY KEY, "
+                "title VARCHAR NOT NULL UNIQUE, url VARCHAR NOT NULL UNIQUE, last_updated DATETIME, "
+                "unread BOOLEAN DEFAULT 1 NOT NULL, remote_id VARCHAR NOT NULL UNIQUE)",
+                "INSERT INTO feed (id, name, url) VALUES (1, 'old feed', 'https://example.com/rss')",
+                "INSERT INTO item (feed_id, id, title, url, last_updated, remote_id) "
+                "VALUES (1, 1, 'Old spotify news', 'https://example.com/1', '2023-03-10 14:20:33.000000', '1')",
+                # the same article stored twice before fingerprints existed
+                "INSERT INTO item (feed_id, id, title, url, last_updated, remote_id) "
+                "VALUES (1, 2, 'old spotify news', 'https://example.com/1?utm_source=rss', "
+                "'2023-03-10 14:20:34.000000', '2')"):
+            connection.execute(db.text(statement))
+
+    runner = app.test_cli_runner()
+    assert runner.invoke(args=["init-db"]).exit_code == 0
+    with app.app_context():
+        columns = {column["name"] for column in db.inspect(db.engine).get_columns("item")}
+        assert {"change_seq", "published_at", "fingerprint", "created_at"} <= columns
+        assert "ix_item_change_seq" in {index["name"] for index in db.inspect(db.engine).get_indexes("item")}
+        item = db.session.get(Item, 1)
+        assert item.created_at == item.last_updated == datetime(2023, 3, 10, 14, 20, 33)
+        assert item.fingerprint == item_fingerprint(item.url, item.title)
+        assert db.session.get(Item, 2).fingerprint is None
+        assert sorted(item.id for item in app_utils.search_items("spotify", 10)[0]) == [1, 2]
+        assert db.session.get(Feed, 1).next_retry_at is None
+        with app.test_client() as client:
+            assert [item["id"] for item in client.get('/items/changes').json["message"]] == [1, 2]
+        with patch("app.utils.fetch_feed", return_value=parsed_rss()):
+            assert update_feed(1)
+        assert Item.query.count() == 4
+    # nothing to do the second time
+    assert runner.invoke(args=["init-db"]).exit_code == 0
+
+
 def test_follow_feed(client):
     response = client.post('/feeds/follow',
                            data=json.dumps(test_feed),
@@ -51,6 +141,44 @@ def test_follow_feed(client):
     assert response.json['success']
 
 
+def test_import_feeds(app, client):
+    client.post('/feeds/follow', data=json.dumps(test_feed), content_type='application/json')
+    feeds = [{"name": "first import", "url": "https://example.com/1.xml"},
+             {"name": "existing url", "url": test_feed["url"]},
+             {"name": "first import", "url": "https://example.com/2.xml"},
+             {"name": "no url"},
+             {"name": "with owner", "url": "https://example.com/3.xml", "owner_email": "owner@example.com"},
+             {"name": "duplicate in import", "url": "https://example.com/3.xml"}]
+    response = client.post('/feeds/import', data=json.dumps(feeds), content_type='application/json')
+    assert response.status_code == 200
+    result = response.json["message"]
+    assert (result["created"], result["conflicts"], result["invalid"]) == (2, 3, 1)
+    assert [row["status"] for row in result["rows"]] == \
+           ["created", "conflict", "conflict", "invalid", "created", "conflict"]
+    assert "url" in result["rows"][3]["errors"]
+    with app.app_context():
+        imported = db.session.get(Feed, result["rows"][4]["id"])
+        assert imported.owner_email == "owner@example.com"
+        # first fetch is done by the background update
+        assert imported.active and imported.next_poll_at is None
+
+    opml = """<?xml version="1.0"?><opml version="2.0"><body><outline text="News">
+    <outline text="OPML feed" type="rss" xmlUrl="https://example.com/opml.xml"/>
+    </outline></body></opml>"""
+    response = client.post('/feeds/import', data=opml, content_type='text/x-opml')
+    assert response.json["message"]["rows"][0]["status"] == "created"
+    response = client.post('/feeds/import', data="<opml", content_type='text/x-opml')
+    assert response.status_code == 400
+
+    # the name of the first row is taken, so the second row with the same url is the created one
+    feeds = [{"name": "first import", "url": "https://example.com/4.xml"},
+             {"name": "fresh", "url": "https://example.com/4.xml"}]
+    rows = client.post('/feeds/import', data=json.dumps(feeds), content_type='application/json').json["message"]["rows"]
+    assert [row["status"] for row in rows] == ["conflict", "created"]
+    with app.app_context():
+        assert db.session.get(Feed, rows[1]["id"]).name == "fresh"
+
+
 def test_unfollow_feed(app, client):
     first_feed = Feed(**test_feed)
     with app.app_context():
@@ -128,3 +256,514 @@ def test_unread_items(app, client):
     assert response.status_code == 200
     assert len(response.json['message']) == 1
     assert response.json['message'][0]['title'] == test_item2["title"]
+
+
+def http_response(status=200, headers=None):
+    response = requests.Response()
+    response.status_code = status
+    response.url = test_feed["url"]
+    response.headers["Content-Type"] = "application/rss+xml; charset=UTF-8"
+    response.headers.update(headers or {})
+    response._content = test_rss.encode() if status == 200 else b""
+    response._content_consumed = True
+    return response
+
+
+def test_update_feed_conditional_get(app):
+    first_feed = Feed(**test_feed)
+    with app.app_context():
+        db.session.add(first_feed)
+        db.session.commit()
+        feed_id = first_feed.id
+        headers = {"ETag": '"v1"', "Last-Modified": "Mon, 13 Mar 2023 10:00:00 GMT"}
+        with patch("app.utils.http_client.get", return_value=http_response(headers=headers)) as get:
+            update_feed(feed_id)
+        assert "If-None-Match" not in get.call_args.kwargs["headers"]
+        assert Item.query.count() == 2
+        assert Feed.query.filter_by(id=feed_id).one().etag == '"v1"'
+
+        with patch("app.utils.http_client.get", return_value=http_response(status=304)) as get, \
+                patch("app.utils.feedparser.parse") as parse:
+            update_feed(feed_id)
+        assert get.call_args.kwargs["headers"]["If-None-Match"] == '"v1"'
+        assert get.call_args.kwargs["headers"]["If-Modified-Since"] == headers["Last-Modified"]
+        assert not parse.called
+        assert Feed.query.filter_by(id=feed_id).one().etag == '"v1"'
+
+
+def test_update_feed_dedup(app):
+    first_feed = Feed(**test_feed)
+    new_item = Item(**test_item1)
+    with app.app_context():
+        db.session.add(first_feed)
+        db.session.commit()
+        new_item.feed_id = first_feed.id
+        db.session.add(new_item)
+        db.session.commit()
+        with patch("app.utils.fetch_feed", return_value=parsed_rss()):
+            update_feed(first_feed.id)
+            update_feed(first_feed.id)
+        assert Item.query.count() == 2
+        assert Item.query.filter_by(remote_id=test_item2["remote_id"]).one().feed_id == first_feed.id
+
+
+def test_update_feed_high_water_mark(app):
+    first_feed = Feed(**test_feed)
+    first_feed.high_water_mark = datetime(2023, 3, 13, 8, 30)
+    feedparsed = parsed_rss()
+    # Last-Modified in a format the old strptime check failed on
+    feedparsed["modified"] = "2023-03-13T10:00:00Z"
+    with app.app_context():
+        db.session.add(first_feed)
+        db.session.commit()
+        with patch("app.utils.fetch_feed", return_value=feedparsed):
+            assert update_feed(first_feed.id)
+        item = Item.query.one()
+        assert item.remote_id == test_item2["remote_id"]
+        assert item.published_at == datetime(2023, 3, 13, 9, 0)
+        assert db.session.get(Feed, first_feed.id).high_water_mark == datetime(2023, 3, 13, 9, 0)
+
+        # feed without a mark takes it from its stored items
+        db.session.get(Feed, first_feed.id).high_water_mark = None
+        db.session.commit()
+        with patch("app.utils.fetch_feed", return_value=parsed_rss()):
+            update_feed(first_feed.id)
+        assert Item.query.count() == 1
+
+
+def test_update_feed_future_entry(app):
+    first_feed = Feed(**test_feed)
+
+    def rss_with_entry(news_id, published):
+        # the newest entry of test feed replaced by another article
+        return feedparser.parse(test_rss.replace(test_item2["remote_id"], f"https://tweakers.net/nieuws/{news_id}")
+                                .replace(test_item2["url"], f"https://tweakers.net/nieuws/{news_id}/")
+                                .replace(test_item2["title"], f"News {news_id}")
+                                .replace("Mon, 13 Mar 2023 09:00:00", published))
+
+    with app.app_context():
+        db.session.add(first_feed)
+        db.session.commit()
+        with patch("app.utils.fetch_feed", return_value=rss_with_entry(1, "Tue, 01 Jan 2030 00:00:00")):
+            update_feed(first_feed.id)
+        assert Item.query.count() == 2
+        assert db.session.get(Feed, first_feed.id).high_water_mark == datetime(2023, 3, 13, 8, 0)
+
+        # the next real entry, published long before the future one
+        with patch("app.utils.fetch_feed", return_value=rss_with_entry(2, "Tue, 14 Mar 2023 09:00:00")):
+            update_feed(first_feed.id)
+        assert Item.query.filter_by(remote_id="https://tweakers.net/nieuws/2").count() == 1
+
+        # a mark which is already in the future is taken again from the stored items
+        db.session.get(Feed, first_feed.id).high_water_mark = datetime(2030, 1, 1)
+        db.session.commit()
+        with patch("app.utils.fetch_feed", return_value=rss_with_entry(3, "Wed, 15 Mar 2023 09:00:00")):
+            update_feed(first_feed.id)
+        assert Item.query.filter_by(remote_id="https://tweakers.net/nieuws/3").count() == 1
+        assert db.session.get(Feed, first_feed.id).high_water_mark == datetime(2023, 3, 15, 9, 0)
+
+
+def test_update_feed_skips_conflicts(app):
+    first_feed = Feed(**test_feed)
+    second_feed = Feed(name="another feed", url="https://example.com/rss")
+    # the same article under another remote id in another feed
+    new_item = Item(title=test_item1["title"], url=test_item1["url"], remote_id="another-id")
+    with app.app_context():
+        db.session.add(first_feed)
+        db.session.add(second_feed)
+        db.session.commit()
+        new_item.feed_id = second_feed.id
+        db.session.add(new_item)
+        db.session.commit()
+        with patch("app.utils.fetch_feed", return_value=parsed_rss()):
+            update_feed(first_feed.id)
+        assert Item.query.filter_by(feed_id=first_feed.id).count() == 1
+        assert Feed.query.filter_by(id=first_feed.id).one().last_updated
+
+
+def test_items_pagination(app, client):
+    first_feed = Feed(**test_feed)
+    with app.app_context():
+        db.session.add(first_feed)
+        db.session.commit()
+        for i in range(5):
+            item = Item(title=f"title {i}", url=f"https://example.com/{i}", remote_id=str(i))
+            item.feed_id = first_feed.id
+            db.session.add(item)
+        db.session.commit()
+        feed_id = first_feed.id
+    titles = []
+    response = client.get(f'/feeds/{feed_id}/items?limit=2')
+    while True:
+        assert response.status_code == 200
+        titles += [item["title"] for item in response.json['message'] or []]
+        if not response.json['next']:
+            break
+        response = client.get(f'/items?limit=2&after={response.json["next"]}')
+    assert titles == [f"title {i}" for i in reversed(range(5))]
+    response = client.get('/items?limit=2&after=broken')
+    assert response.status_code == 422
+
+
+def test_stream_items(app, client):
+    first_feed = Feed(**test_feed)
+    with app.app_context():
+        db.session.add(first_feed)
+        db.session.commit()
+        for item in (test_item1, test_item2):
+            item = Item(**item)
+            item.feed_id = first_feed.id
+            db.session.add(item)
+        db.session.commit()
+        feed_id = first_feed.id
+    response = client.get(f'/feeds/{feed_id}/items')
+    streamed = client.get(f'/feeds/{feed_id}/items?stream=true')
+    assert streamed.status_code == 200
+    assert streamed.json == response.json
+    streamed = client.get('/items?unread=false&stream=true')
+    assert streamed.json == {"success": True}
+    streamed = client.get('/items', headers={"Accept": "application/x-ndjson"})
+    assert [json.loads(line) for line in streamed.data.splitlines()] == response.json["message"]
+
+
+def test_response_cache(app, client):
+    first_feed = Feed(**test_feed)
+    new_item = Item(**test_item1)
+    with app.app_context():
+        db.session.add(first_feed)
+        db.session.commit()
+        new_item.feed_id = first_feed.id
+        db.session.add(new_item)
+        db.session.commit()
+        item_id = new_item.id
+    response_cache.configure("lru")
+    try:
+        assert client.get('/items?unread=true').json['message'][0]['id'] == item_id
+        assert client.get('/items?unread=true').json['message'][0]['id'] == item_id
+        assert client.get('/cache/stats').json['message'] == {"enabled": True, "hits": 1, "misses": 1}
+        client.patch(f'/items/{item_id}', data=json.dumps({"unread": False}), content_type='application/json')
+        assert 'message' not in client.get('/items?unread=true').json
+        assert client.get('/cache/stats').json['message']["misses"] == 2
+    finally:
+        response_cache.configure("none")
+
+
+def test_schedule_next_poll():
+    feed = Feed(**test_feed)
+    now = datetime.utcnow()
+    busy = [now - timedelta(minutes=10 * i) for i in range(10)]
+    feed.schedule_next_poll(busy, True, 60, 86400)
+    assert feed.poll_interval_sec == 600
+    quiet = [now - timedelta(days=30 + i) for i in range(10)]
+    feed.schedule_next_poll(quiet, False, 60, 86400)
+    assert feed.poll_interval_sec == 86400
+    assert feed.next_poll_at > now + timedelta(hours=23)
+    feed.poll_interval_sec = 600
+    feed.schedule_next_poll([], False, 60, 86400)
+    assert feed.poll_interval_sec == 1200
+
+
+def test_claim_due_feeds(app):
+    with app.app_context():
+        for i in range(3):
+            db.session.add(Feed(name=f"feed {i}", url=f"https://example.com/{i}"))
+        db.session.add(Feed(name="inactive", url="https://example.com/inactive"))
+        db.session.commit()
+        Feed.query.filter_by(name="inactive").one().active = False
+        db.session.commit()
+
+        first = Feed.claim_due("first", 2, 300)
+        second = Feed.claim_due("second", 2, 300)
+        assert len(first) == 2
+        assert [feed.name for feed in second] == ["feed 2"]
+        assert Feed.claim_due("third", 2, 300) == []
+
+        Feed.release_leases([feed.id for feed in first], "first")
+        assert len(Feed.claim_due("third", 10, -1)) == 2
+        # lease is already expired
+        assert len(Feed.claim_due("fourth", 10, 300)) == 2
+
+
+def test_set_read_bulk(app, client):
+    first_feed = Feed(**test_feed)
+    with app.app_context():
+        db.session.add(first_feed)
+        db.session.commit()
+        for item in (test_item1, test_item2):
+            item = Item(**item)
+            item.feed_id = first_feed.id
+            db.session.add(item)
+        db.session.commit()
+        feed_id = first_feed.id
+        item_id = Item.query.filter_by(remote_id=test_item1["remote_id"]).one().id
+    response = client.patch('/items', data=json.dumps({"unread": False}), content_type='application/json')
+    assert response.status_code == 400
+    response = client.patch('/items', data=json.dumps({"unread": False, "ids": [item_id]}),
+                            content_type='application/json')
+    assert response.json['message'] == {"updated": 1}
+    response = client.patch('/items', data=json.dumps({"unread": False, "feed_id": feed_id}),
+                            content_type='application/json')
+    assert response.json['message'] == {"updated": 1}
+    future = (datetime.utcnow() + timedelta(days=1)).isoformat() + "Z"
+    response = client.patch('/items', data=json.dumps({"unread": True, "older_than": future}),
+                            content_type='application/json')
+    assert response.json['message'] == {"updated": 2}
+    with app.app_context():
+        assert Item.query.filter_by(unread=True).count() == 2
+
+
+def test_item_changes(app, client):
+    first_feed = Feed(**test_feed)
+    with app.app_context():
+        db.session.add(first_feed)
+        db.session.commit()
+        with patch("app.utils.fetch_feed", return_value=parsed_rss()):
+            update_feed(first_feed.id)
+        item_id = Item.query.filter_by(remote_id=test_item1["remote_id"]).one().id
+    response = client.get('/items/changes')
+    assert len(response.json['message']) == 2
+    cursor = response.json['next']
+    response = client.get(f'/items/changes?since={cursor}')
+    assert 'message' not in response.json
+    assert response.json['next'] == cursor
+
+    client.patch(f'/items/{item_id}', data=json.dumps({"unread": False}), content_type='application/json')
+    response = client.get(f'/items/changes?since={cursor}')
+    assert [item["id"] for item in response.json['message']] == [item_id]
+
+
+def test_change_seq_in_bulk_insert(app):
+    first_feed = Feed(**test_feed)
+    rows = [{"title": f"title {i}", "url": f"https://example.com/{i}", "remote_id": str(i)} for i in range(50)]
+    with app.app_context():
+        db.session.add(first_feed)
+        db.session.commit()
+        rows = [dict(row, feed_id=first_feed.id) for row in rows]
+        statements = []
+
+        def count_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", count_statement)
+        try:
+            app_utils.insert_ignore(Item, rows)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count_statement)
+        db.session.commit()
+        # change_seq is computed by the INSERT itself, not by a query per row
+        assert len(statements) == 1
+        assert Item.query.filter(Item.change_seq.is_(None)).count() == 0
+    statement = db.insert(Item).values(feed_id=1, title="title", url="url", remote_id="id")
+    assert "item_next_change_seq()" in str(statement.compile(dialect=postgresql.dialect()))
+
+
+def test_items_etag(app, client):
+    first_feed = Feed(**test_feed)
+    with app.app_context():
+        db.session.add(first_feed)
+        db.session.commit()
+        with patch("app.utils.fetch_feed", return_value=parsed_rss()):
+            update_feed(first_feed.id)
+        item_id = Item.query.filter_by(remote_id=test_item1["remote_id"]).one().id
+    etag = client.get('/items').headers["ETag"]
+    response = client.get('/items', headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    client.patch(f'/items/{item_id}', data=json.dumps({"unread": False}), content_type='application/json')
+    response = client.get('/items', headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+
+def test_archive_items(app, client):
+    first_feed = Feed(**test_feed)
+    with app.app_context():
+        db.session.add(first_feed)
+        db.session.commit()
+        with patch("app.utils.fetch_feed", return_value=parsed_rss()):
+            update_feed(first_feed.id)
+        newest_id = Item.query.order_by(Item.last_updated.desc(), Item.id.desc()).first().id
+        etag = client.get('/items').headers["ETag"]
+
+        # global policy keeps everything, the feed keeps only its newest item
+        assert archive_items(0, 0, 1) == 0
+        db.session.get(Feed, first_feed.id).retention_max_items = 1
+        db.session.commit()
+        assert archive_items(0, 0, 1) == 1
+        assert [item.id for item in Item.query.all()] == [newest_id]
+        assert ArchivedItem.query.count() == 1
+        assert client.get('/items', headers={"If-None-Match": etag}).status_code == 200
+
+        # archived entry is still listed by the feed, but it isn't inserted again
+        db.session.get(Feed, first_feed.id).last_updated = None
+        db.session.commit()
+        with patch("app.utils.fetch_feed", return_value=parsed_rss()):
+            update_feed(first_feed.id)
+        assert Item.query.count() == 1
+
+        assert archive_items(1, 0, 10) == 0
+        # age is the storing time, marking the item read doesn't postpone its archiving
+        db.session.get(Item, newest_id).created_at = datetime.utcnow() - timedelta(days=2)
+        db.session.commit()
+        feed_id = first_feed.id
+    response = client.patch('/items', data=json.dumps({"unread": False, "feed_id": feed_id}),
+                            content_type='application/json')
+    assert response.json['message'] == {"updated": 1}
+    with app.app_context():
+        assert db.session.get(Item, newest_id).last_updated > datetime.utcnow() - timedelta(days=1)
+        assert archive_items(1, 0, 10) == 1
+
+        # the archived article from another feed is linked to it, not stored again
+        assert ArchivedItem.query.filter(ArchivedItem.fingerprint.is_(None)).count() == 0
+        second_feed = Feed(name="another feed", url="https://example.com/rss")
+        db.session.add(second_feed)
+        db.session.commit()
+        duplicate = parsed_rss()
+        for entry in duplicate.entries:
+            entry["id"] = "another-" + entry["id"]
+        with patch("app.utils.fetch_feed", return_value=duplicate):
+            update_feed(second_feed.id)
+        assert Item.query.count() == 0
+        assert {alias.item_id for alias in ItemAlias.query.all()} == {item.id for item in ArchivedItem.query.all()}
+
+
+def test_item_fingerprint():
+    assert normalize_url("https://www.Example.com/a/?b=2&utm_source=rss&a=1#top") == "example.com/a?a=1&b=2"
+    assert item_fingerprint("http://example.com/a?fbclid=x", " Some  Title") == \
+           item_fingerprint("https://example.com/a/", "some title")
+    assert item_fingerprint("https://example.com/a", "Title") != item_fingerprint("https://example.com/b", "Title")
+
+
+def test_update_feed_links_duplicates(app, client):
+    first_feed = Feed(**test_feed)
+    second_feed = Feed(name="another feed", url="https://example.com/rss")
+    # the same article under another remote id and with tracking parameters in another feed
+    duplicate = parsed_rss()
+    duplicate.entries = duplicate.entries[:1]
+    duplicate.entries[0]["id"] = "another-id"
+    duplicate.entries[0]["link"] += "?utm_source=rss&utm_medium=feed"
+    with app.app_context():
+        db.session.add_all([first_feed, second_feed])
+        db.session.commit()
+        with patch("app.utils.fetch_feed", return_value=parsed_rss()):
+            update_feed(first_feed.id)
+        with patch("app.utils.fetch_feed", return_value=duplicate):
+            update_feed(second_feed.id)
+            db.session.get(Feed, second_feed.id).last_updated = None
+            db.session.commit()
+            update_feed(second_feed.id)
+        assert Item.query.count() == 2
+        alias = ItemAlias.query.one()
+        assert alias.feed_id == second_feed.id and alias.remote_id == "another-id"
+        assert db.session.get(Item, alias.item_id).remote_id == test_item2["remote_id"]
+        second_feed_id = second_feed.id
+
+    # the linked article is listed by the second feed too and can be marked read with it
+    response = client.get(f'/feeds/{second_feed_id}/items?unread=true')
+    assert [item["id"] for item in response.json["message"]] == [alias.item_id]
+    response = client.patch('/items', data=json.dumps({"unread": False, "feed_id": second_feed_id}),
+                            content_type='application/json')
+    assert response.json['message'] == {"updated": 1}
+
+
+def test_fast_serializer(app, client):
+    first_feed = Feed(**test_feed)
+    with app.app_context():
+        db.session.add(first_feed)
+        db.session.commit()
+        with patch("app.utils.fetch_feed", return_value=parsed_rss()):
+            update_feed(first_feed.id)
+        unicode_item = Item(title="Ünïcode “quotes” \u2028 line", url="https://example.com/u", remote_id="u")
+        unicode_item.feed_id = first_feed.id
+        db.session.add(unicode_item)
+        db.session.commit()
+        items = Item.query.order_by(Item.last_updated.desc(), Item.id.desc()).all()
+        feeds = Feed.query.all()
+        expected_items = [item.to_dict() for item in items]
+        expected_feeds = [feed.to_dict() for feed in feeds]
+        rows = Item.query.with_entities(*serialized_columns(Item)).order_by(
+            Item.last_updated.desc(), Item.id.desc()).all()
+        assert serialize_rows(Item, rows) == expected_items
+
+    for orjson in (serializer.orjson, None):
+        with patch("app.serializer.orjson", orjson):
+            assert client.get('/items').json == {"message": expected_items, "success": True}
+            assert client.get(f'/feeds/{first_feed.id}/items?limit=10').json == \
+                   {"message": expected_items, "next": None, "success": True}
+            assert client.get('/feeds').json == {"message": expected_feeds, "success": True}
+            assert client.get('/items?stream=true').json == {"message": expected_items, "success": True}
+            response = client.get('/items', headers={"Accept": "application/x-ndjson"})
+            assert [json.loads(line) for line in response.data.splitlines()] == expected_items
+            assert client.get('/items/changes').json["message"] == sorted(expected_items, key=lambda i: i["id"])
+
+
+def test_search_items(app, client):
+    first_feed = Feed(**test_feed)
+    with app.app_context():
+        db.session.add(first_feed)
+        db.session.commit()
+        with patch("app.utils.fetch_feed", return_value=parsed_rss()):
+            update_feed(first_feed.id)
+    response = client.get('/items/search?q=spotify thuisscherm')
+    assert [item["title"] for item in response.json["message"]] == [test_item1["title"].strip()]
+    assert response.json['next'] is None
+    response = client.get('/items/search?q=regering "OR')
+    assert 'message' not in response.json
+    response = client.get('/items/search?q=uit&limit=1')
+    assert len(response.json['message']) == 1
+    assert response.json['next'] == 1
+    response = client.get('/items/search?q=%20%20')
+    assert response.status_code == 422
+    assert app_utils.search_items(" \t", 10) == ([], None)
+
+
+def test_parse_stream():
+    chunks = [test_rss.encode()[i:i + 100] for i in range(0, len(test_rss), 100)]
+    feedparsed = parse_stream(chunks)
+    assert [e.id for e in feedparsed.entries] == [test_item2["remote_id"], test_item1["remote_id"]]
+    assert feedparsed.entries[0].link == test_item2["url"]
+    assert not feedparsed.truncated
+    feedparsed = parse_stream(chunks, high_water_mark=datetime(2023, 3, 13, 8, 30))
+    assert [e.id for e in feedparsed.entries] == [test_item2["remote_id"]]
+    assert feedparsed.truncated
+    assert len(parse_stream(chunks, max_entries=1).entries) == 1
+
+
+def test_fetch_feed_limits(app):
+    with app.app_context():
+        first_feed = Feed(**test_feed)
+        db.session.add(first_feed)
+        db.session.commit()
+        app.config["FEED_STREAMING_PARSE"] = True
+        try:
+            headers = {"Last-Modified": "Mon, 13 Mar 2023 10:00:00 GMT"}
+            with patch("app.utils.http_client.get", return_value=http_response(headers=headers)):
+                update_feed(first_feed.id)
+            assert Item.query.count() == 2
+            assert Feed.query.filter_by(id=first_feed.id).one().high_water_mark == datetime(2023, 3, 13, 9)
+            # not well-formed XML is parsed by feedparser
+            broken = http_response()
+            broken._content = test_rss.replace("<title>Tweakers", "<title>&nbsp;Tweakers").encode()
+            with patch("app.utils.http_client.get", return_value=broken):
+                assert len(app_utils.fetch_feed(test_feed["url"]).entries) == 2
+        finally:
+            app.config["FEED_STREAMING_PARSE"] = False
+        app.config["MAX_FEED_BYTES"], max_bytes = 100, app.config["MAX_FEED_BYTES"]
+        try:
+            with patch("app.utils.http_client.get", return_value=http_response()), pytest.raises(FeedTooLarge):
+                update_feed(first_feed.id)
+        finally:
+            app.config["MAX_FEED_BYTES"] = max_bytes
+
+
+def test_metrics(app, client):
+    first_feed = Feed(**test_feed)
+    with app.app_context():
+        db.session.add(first_feed)
+        db.session.commit()
+        with patch("app.utils.fetch_feed", return_value=parsed_rss()):
+            update_feed(first_feed.id)
+    client.get('/items')
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert b'rss_http_request_duration_seconds_count{endpoint="/items",method="GET",status="200"}' in response.data
+    assert b'rss_feed_entries_total{result="new"}' in response.data
@@ -1,61 +1,604 @@
+import base64
+import hashlib
+import time
 import feedparser
-from datetime import datetime
+from xml.etree import ElementTree
+from xml.etree.ElementTree import ParseError
+from datetime import datetime, timedelta
+from functools import wraps
+from flask import current_app, make_response, request, Response, stream_with_context
+from sqlalchemy import func, literal_column, or_, text, tuple_, Float, Integer
+from sqlalchemy.dialects import postgresql, sqlite
 from app.models.Feed import Feed
 from app.models.Item import Item
-from app import app, db
+from app.models.ArchivedItem import ArchivedItem
+from app.models.ItemAlias import ItemAlias
+from app import db
+from app.cache import response_cache
+from app.http_client import http_client
+from app.metrics import FEED_FETCH_SECONDS, FEED_FETCH_BYTES, FEED_PARSE_SECONDS, FEED_DB_SECONDS, FEED_ENTRIES, \
+    FEED_NEW_ENTRIES
+from app.fingerprint import item_fingerprint
+from app.serializer import dumps, serialize_rows, serialized_columns
+from app.stream_parser import parse_stream, read_limited
 
 
-def prepare_response(success, message=None):
+def prepare_response(success, message=None, **extra):
     result = {"success": success}
     if message:
         result["message"] = message
+    result.update(extra)
     return result
 
 
-def update_feed(feed_id):
+def encode_cursor(*values):
+    """
+    Opaque pagination cursor made of sort key values of the last item on a page.
+    Listings are ordered by (last_updated, id), changes by (change_seq, id)
+    """
+    raw = "|".join(str(value) for value in values)
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor, *types):
+    """
+    :param types: Functions to convert every cursor value, e.g. datetime.fromisoformat, int
+    :return: tuple of values
+    :raise ValueError: if cursor is malformed
+    """
+    try:
+        values = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        if len(values) != len(types):
+            raise ValueError("Wrong number of values")
+        return tuple(convert(value) for convert, value in zip(types, values))
+    except (ValueError, UnicodeError) as e:
+        raise ValueError(f"Invalid cursor {cursor}") from e
+
+
+def listing_cursor(item):
+    return encode_cursor(item.last_updated.isoformat(), item.id)
+
+
+def change_cursor(item):
+    return encode_cursor(item.change_seq, item.id)
+
+
+def items_etag():
+    """
+    Validator for item listings (ETag / If-None-Match). It changes whenever any item is created, updated
+    or archived (or linked to another feed), and it's taken from the indexes only, so a poll with nothing
+    changed costs four index lookups
+    """
+    max_change_seq, max_id = db.session.query(func.max(Item.change_seq), func.max(Item.id)).one()
+    last_archived_at = db.session.query(func.max(ArchivedItem.archived_at)).scalar()
+    # linked duplicates are listed by their feeds too
+    max_alias_id = db.session.query(func.max(ItemAlias.id)).scalar()
+    accept = request.accept_mimetypes.best_match(["application/json", NDJSON_MIMETYPE])
+    return hashlib.md5(f"{request.full_path}|{accept}|{max_change_seq}|{max_id}|{last_archived_at}|"
+                       f"{max_alias_id}".encode()).hexdigest()
+
+
+def conditional_response(view):
+    """
+    Decorator for item listings: answers 304 if client already has the current version (If-None-Match),
+    otherwise sets ETag of the response
+    """
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        etag = items_etag()
+        if etag in request.if_none_match:
+            response = Response(status=304)
+        else:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+        response.set_etag(etag)
+        return response
+
+    return wrapper
+
+
+# Rows fetched from server-side cursor at once while streaming
+STREAM_CHUNK_SIZE = 500
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+
+def order_items(query, after=None):
+    """
+    Orders items from newest to oldest and skips items up to the cursor
+    :param after: Decoded cursor (last_updated, id)
+    """
+    query = query.order_by(Item.last_updated.desc(), Item.id.desc())
+    if after:
+        query = query.filter(tuple_(Item.last_updated, Item.id) < after)
+    return query
+
+
+def paginate_items(query, limit=None, after=None):
+    """
+    Keyset pagination of items from newest to oldest. Page is taken by index range scan
+    (see Item indexes), so any page costs the same as the first one.
+    :param query: Item query with filters
+    :param limit: Page size. If None - all items are returned
+    :param after: Decoded cursor (last_updated, id) of the last item from the previous page
+    :return: tuple (list of items, cursor for the next page or None if it's the last page)
+    """
+    query = order_items(query, after)
+    if limit is None:
+        return query.all(), None
+    items = query.limit(limit + 1).all()
+    next_cursor = listing_cursor(items[limit - 1]) if len(items) > limit else None
+    return items[:limit], next_cursor
+
+
+def item_changes(since=None, limit=None):
+    """
+    Items created or updated after the cursor, in order of changes. change_seq order is the commit order
+    (see app.models.Item.next_change_seq), so a change which commits later doesn't appear behind the cursor
+    :param since: Decoded change cursor (change_seq, id). If None - all items
+    :return: tuple (list of item rows for serialize_rows, cursor to poll next changes with)
+    """
+    query = Item.query.with_entities(*serialized_columns(Item), Item.change_seq).filter(
+        Item.change_seq.isnot(None)).order_by(Item.change_seq, Item.id)
+    if since:
+        query = query.filter(tuple_(Item.change_seq, Item.id) > since)
+    items = query.limit(limit).all()
+    if items:
+        return items, change_cursor(items[-1])
+    return items, encode_cursor(*since) if since else None
+
+
+def fetch_feed(url, etag=None, modified=None, high_water_mark=None):
+    """
+    Downloads and parses feed document (see download_feed), measuring fetch time
+    """
+    started = time.perf_counter()
+    try:
+        feedparsed = download_feed(url, etag, modified, high_water_mark)
+    except Exception:
+        FEED_FETCH_SECONDS.labels("error").observe(time.perf_counter() - started)
+        raise
+    FEED_FETCH_SECONDS.labels("not_modified" if not_modified(feedparsed) else "ok").observe(
+        time.perf_counter() - started)
+    return feedparsed
+
+
+def download_feed(url, etag=None, modified=None, high_water_mark=None):
+    """
+    Downloads and parses feed document.
+    Doesn't touch the database, so it's safe to call it from several threads at once.
+
+    Document is downloaded by shared pooled HTTP client (keep-alive, gzip), feedparser only parses the bytes.
+    etag and modified are values saved from the previous fetch. They are sent back as a conditional GET,
+    so the server answers with status 304 and an empty body if the feed hasn't changed.
+    Body larger than MAX_FEED_BYTES fails the fetch, only first MAX_FEED_ENTRIES entries are taken.
+
+    With FEED_STREAMING_PARSE entries are parsed while downloading and download stops at the first entry
+    which is not newer than high_water_mark (see app.stream_parser). Documents which are not well-formed XML
+    are parsed by feedparser as usual.
+    """
+    headers = {"User-Agent": feedparser.USER_AGENT, "Accept": feedparser.http.ACCEPT_HEADER}
+    if etag:
+        headers["If-None-Match"] = etag
+    if modified:
+        headers["If-Modified-Since"] = modified
+    with http_client.get(url, headers=headers, stream=True) as response:
+        if response.status_code == 304:
+            return feedparser.FeedParserDict(status=304, href=response.url, entries=[], etag=etag, modified=modified)
+        response.raise_for_status()
+
+        received = []
+        chunks = read_limited(response, current_app.config["MAX_FEED_BYTES"], received)
+        response_headers = {key.lower(): value for key, value in response.headers.items()}
+        feedparsed = None
+        if current_app.config["FEED_STREAMING_PARSE"]:
+            try:
+                with FEED_PARSE_SECONDS.time():
+                    feedparsed = parse_stream(chunks, trusted_high_water_mark(high_water_mark),
+                                              current_app.config["MAX_FEED_ENTRIES"])
+            except ParseError as e:
+                current_app.logger.info(f"Feed {url} can't be parsed incrementally ({e}), parsing it by feedparser")
+        if feedparsed is None:
+            # read the rest of document (if streaming parser has failed in the middle)
+            for _ in chunks:
+                pass
+            with FEED_PARSE_SECONDS.time():
+                feedparsed = feedparser.parse(b"".join(received), response_headers=response_headers)
+            del feedparsed.entries[current_app.config["MAX_FEED_ENTRIES"]:]
+        FEED_FETCH_BYTES.inc(sum(len(chunk) for chunk in received))
+    feedparsed["status"] = response.status_code
+    feedparsed["href"] = response.url
+    if response.headers.get("ETag"):
+        feedparsed["etag"] = response.headers["ETag"]
+    if response.headers.get("Last-Modified"):
+        feedparsed["modified"] = response.headers["Last-Modified"]
+    return feedparsed
+
+
+def not_modified(feedparsed):
+    return feedparsed.get("status") == 304
+
+
+def entry_datetime(entry):
+    """
+    :return: Naive UTC datetime when entry was published (or updated), None if feed has no dates
+    """
+    parsed = entry.get("published_parsed") or entry.get("updated_parsed")
+    return datetime(*parsed[:6]) if parsed else None
+
+
+# Entries dated later than now plus this skew don't move the high water mark (wrong clock or date in the feed),
+# otherwise one such entry would make all entries published before its date look old
+FUTURE_ENTRY_SKEW = timedelta(hours=1)
+
+
+def latest_trusted_time():
+    return datetime.utcnow() + FUTURE_ENTRY_SKEW
+
+
+def trusted_high_water_mark(high_water_mark):
+    """
+    :return: The mark, or None if it's from the future (it hides entries instead of skipping the old ones)
+    """
+    if high_water_mark is None or high_water_mark > latest_trusted_time():
+        return None
+    return high_water_mark
+
+
+def newer_entries(feed, entries):
+    """
+    :return: Entries published not before feed's high water mark and entries without dates.
+             Feeds which have no mark yet (or have a mark from the future) get it from their stored items
+             (by Item.published_at index)
+    """
+    if trusted_high_water_mark(feed.high_water_mark) is None:
+        latest = latest_trusted_time()
+        feed.high_water_mark = db.session.query(func.max(Item.published_at)).filter(
+            Item.feed_id == feed.id, Item.published_at <= latest).scalar()
+    if feed.high_water_mark is None:
+        return list(entries)
+    return [e for e in entries if (entry_datetime(e) or feed.high_water_mark) >= feed.high_water_mark]
+
+
+def raise_high_water_mark(feed, feedparsed):
+    """
+    Moves feed's high water mark (publish time of the newest entry we have) forward.
+    Entries from the future are saved, but they don't move the mark
+    """
+    latest = latest_trusted_time()
+    entry_times = [t for t in map(entry_datetime, feedparsed.get("entries", [])) if t]
+    future = [t for t in entry_times if t > latest]
+    if future:
+        current_app.logger.warning(f"Feed {feed.name} has {len(future)} entries dated in the future "
+                                   f"(up to {max(future)}), they don't move its high water mark")
+    entry_times = [t for t in entry_times if t <= latest]
+    if entry_times and (feed.high_water_mark is None or max(entry_times) > feed.high_water_mark):
+        feed.high_water_mark = max(entry_times)
+
+
+def schedule_next_poll(feed, feedparsed, has_new):
+    entry_times = [t for t in map(entry_datetime, feedparsed.get("entries", [])) if t]
+    feed.schedule_next_poll(entry_times, has_new,
+                            current_app.config["POLL_MIN_INTERVAL_SEC"], current_app.config["POLL_MAX_INTERVAL_SEC"])
+
+
+def stream_items(query, ndjson=False):
+    """
+    Streaming response with all items of the query. Rows are read from server-side cursor
+    by chunks and written to the client as soon as they're serialized, so memory usage
+    doesn't depend on the number of items.
+    :param query: Ordered Item query
+    :param ndjson: If True - one item per line (NDJSON), otherwise the same JSON document as prepare_response gives
+    """
+    rows = query.with_entities(*serialized_columns(Item)).yield_per(STREAM_CHUNK_SIZE)
+
+    def serialize_chunk(chunk):
+        return b"".join(dumps(item) + b"\n" for item in serialize_rows(Item, chunk))
+
+    def generate_ndjson():
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == STREAM_CHUNK_SIZE:
+                yield serialize_chunk(chunk)
+                chunk = []
+        yield serialize_chunk(chunk)
+
+    def generate_json():
+        # keys are in the same (sorted) order as jsonify writes them
+        opened = False
+        for chunk in generate_ndjson():
+            if chunk:
+                yield (b"," if opened else b'{"message":[') + b",".join(chunk.splitlines())
+                opened = True
+        yield b'],"success":true}\n' if opened else b'{"success":true}\n'
+
+    if ndjson:
+        return Response(stream_with_context(generate_ndjson()), mimetype=NDJSON_MIMETYPE)
+    return Response(stream_with_context(generate_json()), mimetype="application/json")
+
+
+def search_items(q, limit, offset=0):
+    """
+    Full-text search over item titles, best matches first.
+    PostgreSQL uses GIN index over tsvector (websearch syntax of query), SQLite - FTS5 with bm25 rank
+    (every word of query must be in title).
+    :return: tuple (list of items, offset of the next page or None if it's the last page)
+    """
+    if not q.split():
+        return [], None
+    dialect = db.session.get_bind().dialect.name
+    if dialect == "postgresql":
+        tsquery = func.websearch_to_tsquery("simple", q)
+        search_vector = literal_column("item.search_vector")
+        query = Item.query.filter(search_vector.op("@@")(tsquery)).order_by(
+            func.ts_rank_cd(search_vector, tsquery).desc(), Item.id.desc())
+    elif dialect == "sqlite":
+        # every word is quoted, so FTS5 query syntax in user input is not interpreted
+        match = " ".join('"{}"'.format(word.replace('"', '""')) for word in q.split())
+        found = text("SELECT rowid AS id, bm25(item_fts) AS rank FROM item_fts WHERE item_fts MATCH :match") \
+            .bindparams(match=match).columns(id=Integer, rank=Float).subquery()
+        query = Item.query.join(found, found.c.id == Item.id).order_by(found.c.rank, Item.id.desc())
+    else:
+        raise NotImplementedError(f"Full-text search is not supported for {dialect} database")
+    items = query.offset(offset).limit(limit + 1).all()
+    next_offset = offset + limit if len(items) > limit else None
+    return items[:limit], next_offset
+
+
+# Rows per one INSERT statement (keeps number of bound parameters under SQLite limits)
+INSERT_CHUNK_SIZE = 500
+
+
+def dialect_insert():
+    """
+    :return: insert() of the current database dialect, which supports ON CONFLICT
+    """
+    dialect = db.session.get_bind().dialect.name
+    if dialect == "postgresql":
+        return postgresql.insert
+    elif dialect == "sqlite":
+        return sqlite.insert
+    raise NotImplementedError(f"Bulk insert is not supported for {dialect} database")
+
+
+def insert_ignore(model, rows):
+    """
+    Bulk insert which tolerates unique constraint conflicts: one multi-row
+    INSERT ... ON CONFLICT DO NOTHING per chunk of rows (PostgreSQL and SQLite).
+    :param model: Model class
+    :param rows: list of dicts with column values
+    :return: Number of inserted rows. Conflicting rows are skipped, so it can be less than len(rows)
+    """
+    insert = dialect_insert()
+    inserted = 0
+    for start in range(0, len(rows), INSERT_CHUNK_SIZE):
+        statement = insert(model.__table__).values(rows[start:start + INSERT_CHUNK_SIZE]).on_conflict_do_nothing()
+        inserted += db.session.execute(statement).rowcount
+    return inserted
+
+
+def insert_ignore_returning(model, rows, *columns):
+    """
+    The same as insert_ignore, but tells which rows were inserted (INSERT ... ON CONFLICT DO NOTHING RETURNING)
+    :param columns: Columns to return, e.g. id and a unique column to match returned rows with the given ones
+    :return: list of returned rows (only inserted ones)
+    """
+    insert = dialect_insert()
+    returned = []
+    for start in range(0, len(rows), INSERT_CHUNK_SIZE):
+        statement = insert(model.__table__).values(
+            rows[start:start + INSERT_CHUNK_SIZE]).on_conflict_do_nothing().returning(*columns)
+        returned += db.session.execute(statement).all()
+    return returned
+
+
+def import_feeds(feeds):
+    """
+    Follows many feeds at once by set-based insert, feeds which conflict with existing ones
+    (the same name or url) are skipped. New feeds have no next_poll_at, so the background update
+    fetches them first, as soon as possible (see Feed.claim_due).
+    :param feeds: list of dicts with name, url and optional owner_email
+    :return: dict (name, url) -> id of created feeds (both are unique, a row conflicts by any of them)
+    """
+    rows = [{"name": feed["name"], "url": feed["url"], "owner_email": feed.get("owner_email")} for feed in feeds]
+    created = {(name, url): feed_id
+               for feed_id, name, url in insert_ignore_returning(Feed, rows, Feed.id, Feed.name, Feed.url)}
+    db.session.commit()
+    if created:
+        response_cache.invalidate()
+    return created
+
+
+def parse_opml(document):
+    """
+    :param document: OPML document (bytes), feeds are outlines with xmlUrl attribute (at any nesting level)
+    :return: list of dicts with name and url
+    :raise ParseError: if document is not well-formed XML
+    """
+    feeds = []
+    for outline in ElementTree.fromstring(document).iter("outline"):
+        url = outline.get("xmlUrl")
+        if url:
+            feeds.append({"name": outline.get("title") or outline.get("text") or url, "url": url.strip()})
+    return feeds
+
+
+def update_feed(feed_id, feedparsed=None):
     """
     :param feed_id: Feed id to be updated
+    :param feedparsed: Already fetched feed (e.g. by concurrent fetcher). If None - feed is fetched here
     :return: True if everything was ok
 
     The function has three parts (it's not divided by more funcs because these
     parts are not reusable at the moment):
-        1) It parses feed by url
-        2) Checks if there are new updates from last_updated feed in our app
-        3) Compare feed items by remote id and if there are any new items - adds it to our app
+        1) It parses feed by url (or stops right here if server says that feed is not modified)
+           and schedules next poll of the feed by its publish frequency
+        2) Skips entries published before feed's high water mark (publish time of the newest entry we have),
+           so only new entries go further. Entries without dates are always checked
+        3) Compare feed items by remote id and if there are any new items - adds it to our app.
+           Only remote ids of incoming entries are looked up (by feed_id + remote_id index),
+           so the cost doesn't depend on the total number of items.
+           New items are inserted in bulk, items which conflict with existing ones
+           (e.g. the same title in another feed) are skipped and counted, not failing the whole feed.
+           Entries with the fingerprint (normalized url and title) of a stored (or archived) item are the same article
+           from another feed, they are linked to that item by ItemAlias instead of being stored twice
     """
     feed = Feed.query.filter_by(id=feed_id).one()
-    app.logger.info(f"Trying to parse feed {feed.name} with url {feed.url}")
-    feedparsed = feedparser.parse(feed.url)
+    if feedparsed is None:
+        current_app.logger.info(f"Trying to parse feed {feed.name} with url {feed.url}")
+        feedparsed = fetch_feed(feed.url, feed.etag, feed.modified, feed.high_water_mark)
+    if not_modified(feedparsed):
+        current_app.logger.info(f"Feed {feed.name} is not modified since last fetch. Skipping...")
+        schedule_next_poll(feed, feedparsed, has_new=False)
+        db.session.commit()
+        return True
     if "bozo_exception" in feedparsed.keys():
         raise Exception(feedparsed.bozo_exception)
 
-    # Check for new items by date in feed
-    datetime_str = '%a, %d %b %Y %H:%M:%S %Z'
-    feedparsed_date_parsed = datetime.strptime(feedparsed.updated, datetime_str)
-    if feed.last_updated and feedparsed_date_parsed < feed.last_updated:
-        app.logger.info(f"Seems feed {feed.name} hasn't new items from last update. Skipping...")
-        return True
+    # Remember validators for the next conditional fetch
+    feed.etag = feedparsed.get("etag")
+    feed.modified = feedparsed.get("modified")
 
-    # retrieve the remote_id field of all users feeds values() method
-    list_of_remote_ids = [remote_id for (remote_id,) in db.session.query(Item.remote_id).all()]
-    any_new = False
-    for e in feedparsed.entries:
-        # check if item from feed don't exist it our db
-        if e.id not in list_of_remote_ids:
-            any_new = True
-            entry = Item(title=e.title, url=e.link, remote_id=e.id)
-            feed.items.append(entry)
+    db_started = time.perf_counter()
+    # entries published before the newest stored one are already stored (or archived), they aren't looked up
+    entries = newer_entries(feed, feedparsed.entries)
+    # retrieve only those remote ids of the feed which came in this update
+    incoming_remote_ids = {e.id for e in entries}
+    known_remote_ids = set()
+    if incoming_remote_ids:
+        # archived items (see archive_items) are known too, otherwise they come back while feed still lists them,
+        # and so are entries linked to the same article of another feed
+        for model in (Item, ArchivedItem, ItemAlias):
+            known_remote_ids.update(remote_id for (remote_id,) in db.session.query(model.remote_id).filter(
+                model.feed_id == feed.id, model.remote_id.in_(incoming_remote_ids)))
+    new_items, duplicates = {}, []
+    for e in entries:
+        # check if item from feed don't exist it our db (or wasn't already added from this update)
+        if e.id not in known_remote_ids:
+            known_remote_ids.add(e.id)
+            fingerprint = item_fingerprint(e.link, e.title)
+            if fingerprint in new_items:
+                duplicates.append((e.id, fingerprint))
+            else:
+                stored_at = datetime.utcnow()
+                new_items[fingerprint] = {"feed_id": feed.id, "title": e.title, "url": e.link, "remote_id": e.id,
+                                          "fingerprint": fingerprint, "published_at": entry_datetime(e),
+                                          "last_updated": stored_at, "created_at": stored_at}
+    # the same article is already stored (e.g. from another feed) - link the entry instead of storing it again
+    if new_items:
+        for model in (Item, ArchivedItem):
+            for (fingerprint,) in db.session.query(model.fingerprint).filter(model.fingerprint.in_(list(new_items))):
+                if fingerprint in new_items:
+                    duplicates.append((new_items.pop(fingerprint)["remote_id"], fingerprint))
+    inserted = insert_ignore(Item, list(new_items.values())) if new_items else 0
+    linked = link_duplicates(feed, duplicates) if duplicates else 0
+    raise_high_water_mark(feed, feedparsed)
+    schedule_next_poll(feed, feedparsed, has_new=inserted > 0)
     db.session.commit()
-    if any_new:
-        app.logger.info(f"Feed {feed.name} was successfully updated")
+    FEED_DB_SECONDS.observe(time.perf_counter() - db_started)
+    FEED_ENTRIES.labels("new").inc(inserted)
+    FEED_ENTRIES.labels("linked").inc(linked)
+    FEED_ENTRIES.labels("old").inc(len(feedparsed.entries) - len(entries))
+    FEED_ENTRIES.labels("duplicate").inc(len(entries) - len(new_items) - len(duplicates))
+    FEED_ENTRIES.labels("conflict").inc(len(new_items) - inserted + len(duplicates) - linked)
+    FEED_NEW_ENTRIES.observe(inserted)
+    if len(new_items) > inserted:
+        current_app.logger.warning(f"{len(new_items) - inserted} new items of feed {feed.name} were skipped "
+                                   f"because they conflict with existing items")
+    if inserted:
+        current_app.logger.info(f"Feed {feed.name} was successfully updated with {inserted} new items")
         feed.touch()
+        response_cache.invalidate()
     else:
-        app.logger.info(f"No new items in Feed {feed.name} was founded")
+        current_app.logger.info(f"No new items in Feed {feed.name} was founded")
     return True
 
 
+def link_duplicates(feed, duplicates):
+    """
+    :param duplicates: list of (remote_id, fingerprint) of feed entries which are the same articles as stored items
+    :return: Number of linked entries
+    """
+    fingerprints = {fingerprint for _, fingerprint in duplicates}
+    # an archived article keeps its id, stored items win over archived ones with the same fingerprint
+    item_ids = {}
+    for model in (ArchivedItem, Item):
+        item_ids.update(db.session.query(model.fingerprint, model.id).filter(model.fingerprint.in_(fingerprints)))
+    return insert_ignore(ItemAlias, [{"feed_id": feed.id, "remote_id": remote_id, "item_id": item_ids[fingerprint]}
+                                     for remote_id, fingerprint in duplicates if fingerprint in item_ids])
+
+
+def feed_items_filter(feed_id):
+    """
+    Items of the feed: the ones stored from it and the ones linked to it as the same articles
+    of another feed (see link_duplicates), so linking doesn't hide articles from the feed
+    """
+    linked = db.select(ItemAlias.item_id).where(ItemAlias.feed_id == feed_id)
+    return or_(Item.feed_id == feed_id, Item.id.in_(linked))
+
+
 def update_all_feeds():
     feeds = Feed.query.all()
     for feed in feeds:
         update_feed(feed.id)
     return True
+
+
+def expired_items_filter(feed, max_age_days, max_items):
+    """
+    Age and order of items are by their storing time (Item.created_at), so reading an item
+    doesn't postpone its archiving
+    :param max_age_days: Items stored more than this number of days ago are expired (0 - no limit)
+    :param max_items: Only this number of the newest items of the feed are kept (0 - no limit)
+    :return: Filter of expired items of the feed or None if the feed keeps everything
+    """
+    conditions = []
+    if max_age_days:
+        conditions.append(Item.created_at < datetime.utcnow() - timedelta(days=max_age_days))
+    if max_items:
+        # the oldest item which is kept, everything stored before it is expired
+        cutoff = db.session.query(Item.created_at, Item.id).filter(Item.feed_id == feed.id).order_by(
+            Item.created_at.desc(), Item.id.desc()).offset(max_items - 1).limit(1).first()
+        if cutoff:
+            conditions.append(tuple_(Item.created_at, Item.id) < tuple_(*cutoff))
+    if not conditions:
+        return None
+    return db.and_(Item.feed_id == feed.id, or_(*conditions))
+
+
+def archive_items(max_age_days, max_items, batch_size):
+    """
+    Moves expired items to archived_item table, so the item table (and its indexes used by listings
+    and dedup) keeps only the recent items. Policy of the feed (Feed.retention_*) overrides the global one.
+    Items are moved by batches of batch_size rows, every batch is its own short transaction
+    (INSERT ... SELECT and DELETE by primary keys), so cleanup doesn't hold long locks.
+    :return: Number of archived items
+    """
+    archived = 0
+    for feed in Feed.query.order_by(Feed.id).all():
+        expired = expired_items_filter(
+            feed,
+            max_age_days if feed.retention_max_age_days is None else feed.retention_max_age_days,
+            max_items if feed.retention_max_items is None else feed.retention_max_items)
+        if expired is None:
+            continue
+        while True:
+            ids = db.session.scalars(db.select(Item.id).where(expired).order_by(Item.id).limit(batch_size)).all()
+            if not ids:
+                break
+            columns = [Item.feed_id, Item.id, Item.title, Item.url, Item.last_updated, Item.unread, Item.remote_id,
+                       Item.change_seq, Item.published_at, Item.created_at, Item.fingerprint]
+            db.session.execute(db.insert(ArchivedItem).from_select(
+                [column.key for column in columns] + ["archived_at"],
+                db.select(*columns, db.literal(datetime.utcnow(), db.DateTime)).where(Item.id.in_(ids))))
+            db.session.execute(db.delete(Item).where(Item.id.in_(ids)))
+            db.session.commit()
+            archived += len(ids)
+            if len(ids) < batch_size:
+                break
+    if archived:
+        current_app.logger.info(f"{archived} expired items were archived")
+        response_cache.invalidate()
+    return archived
@@ -1,15 +1,63 @@
+from datetime import datetime, timezone
+from marshmallow import Schema, ValidationError
 from webargs import fields, validate
 
+from app.utils import decode_cursor
+
+
+class Cursor(fields.Str):
+    """
+    Pagination cursor, deserialized to tuple of values converted by types.
+    Listing cursor (default) is (last_updated, id)
+    """
+
+    def __init__(self, *types, **kwargs):
+        super().__init__(**kwargs)
+        self.types = types or (datetime.fromisoformat, int)
+
+    def _deserialize(self, value, attr, data, **kwargs):
+        try:
+            return decode_cursor(super()._deserialize(value, attr, data, **kwargs), *self.types)
+        except ValueError:
+            raise ValidationError("Invalid cursor.")
+
+
 follow_feed_schema = {
     "name": fields.Str(required=True, validate=validate.Length(min=3)),
     "url": fields.Url(required=True),
     "owner_email": fields.Str(required=False),
 }
 
+# one feed of bulk import (POST /feeds/import), rows are validated one by one
+import_feed_schema = Schema.from_dict(follow_feed_schema, name="ImportFeedSchema")()
+
 set_read_schema = {
     "unread": fields.Bool(required=True),
 }
 
+set_read_bulk_schema = {
+    "unread": fields.Bool(required=True),
+    "ids": fields.List(fields.Int(), required=False, validate=validate.Length(min=1, max=10000)),
+    "feed_id": fields.Int(required=False),
+    "older_than": fields.NaiveDateTime(required=False, timezone=timezone.utc),
+    "after": Cursor(required=False),
+}
+
 get_all_items_schema = {
     "unread": fields.Bool(required=False),
+    "limit": fields.Int(required=False, validate=validate.Range(min=1, max=1000)),
+    "after": Cursor(required=False),
+    "stream": fields.Bool(required=False),
+}
+
+get_item_changes_schema = {
+    "since": Cursor(int, int, required=False),
+    "limit": fields.Int(required=False, load_default=500, validate=validate.Range(min=1, max=1000)),
+}
+
+search_items_schema = {
+    "q": fields.Str(required=True, validate=[validate.Length(min=1, max=256),
+                                             validate.Regexp(r"\s*\S", error="Query has no words.")]),
+    "limit": fields.Int(required=False, load_default=20, validate=validate.Range(min=1, max=100)),
+    "offset": fields.Int(required=False, load_default=0, validate=validate.Range(min=0, max=1000)),
 }
@@ -0,0 +1,18 @@
+from flask import jsonify, Blueprint
+
+from app.cache import response_cache
+from app.utils import prepare_response
+
+bp = Blueprint("cache", __name__)
+
+
+@bp.get('/cache/stats')
+def get_cache_stats():
+    """
+    Response cache hit/miss counters
+    ---
+    responses:
+        200:
+            description: Cache counters (only "enabled" field if cache is turned off)
+    """
+    return jsonify(prepare_response(True, response_cache.stats()))
@@ -1,19 +1,28 @@
-from flask import jsonify
+from collections import Counter
+from flask import jsonify, request, Blueprint, current_app
 from webargs.flaskparser import use_args, use_kwargs
 from sqlalchemy.exc import NoResultFound
 from sqlalchemy.exc import IntegrityError
+from xml.etree.ElementTree import ParseError
 
-from app import app, db
+from app import db
+from app.cache import response_cache
 from app.models.Feed import Feed
 from app.models.Item import Item
-from app.utils import update_feed, update_all_feeds, prepare_response
-from app.validation_schemas import follow_feed_schema, get_all_items_schema
+from app.utils import update_feed, update_all_feeds, prepare_response, paginate_items, \
+    order_items, stream_items, NDJSON_MIMETYPE, conditional_response, import_feeds, parse_opml, \
+    feed_items_filter
+from app.serializer import json_response, serialize_rows, serialized_columns
+from app.validation_schemas import follow_feed_schema, get_all_items_schema, import_feed_schema
+
+bp = Blueprint("feeds", __name__)
 
 no_feed_msg = "Feed with id {} not found"
+OPML_MIMETYPES = ("text/x-opml", "text/xml", "application/xml")
 
 
-@app.errorhandler(422)
-@app.errorhandler(400)
+@bp.app_errorhandler(422)
+@bp.app_errorhandler(400)
 def handle_error(err):
     headers = err.data.get("headers", None)
     messages = err.data.get("messages", ["Invalid request."])
@@ -23,7 +32,7 @@ def handle_error(err):
         return jsonify(prepare_response(False, messages)), err.code
 
 
-@app.post('/feeds/follow')
+@bp.post('/feeds/follow')
 @use_args(follow_feed_schema)
 def follow_feed(args):
     """
@@ -83,13 +92,88 @@ def follow_feed(args):
         db.session.commit()
         db.session.refresh(feed)
     except IntegrityError as e:
-        app.logger.error(e)
+        current_app.logger.error(e)
         return jsonify(prepare_response(False, "name or url already exists")), 400
+    response_cache.invalidate()
     new_feed["id"] = feed.id
     return jsonify(prepare_response(True, new_feed)), 201
 
 
-@app.post('/feeds/<feed_id>/unfollow')
+@bp.post('/feeds/import')
+def import_feeds_view():
+    """
+    Follow many feeds at once: JSON array of feeds (the same fields as /feeds/follow) or OPML document
+    (request body with XML content type or "file" field of a form). First fetch of new feeds is done
+    by the background update, not in this request.
+    ---
+    parameters:
+      - name: feeds
+        in: body
+        type: array
+        required: true
+        example: [{"name": "Test feed", "url": "https://feeds.feedburner.com/tweakers/mixed"}]
+    definitions:
+        FeedImportResponse:
+            type: object
+            properties:
+                message:
+                    type: object
+                    properties:
+                        created:
+                            type: integer
+                        conflicts:
+                            type: integer
+                        invalid:
+                            type: integer
+                        rows:
+                            type: array
+                            description: Result of every row in order of the request, status is created
+                                         (with id), conflict (name or url already exists) or invalid (with errors)
+                success:
+                    type: boolean
+    responses:
+        200:
+            description: Result of every row
+            schema:
+                $ref: '#/definitions/FeedImportResponse'
+        400:
+            description: Not a JSON array or OPML document, or too many feeds
+    """
+    try:
+        if "file" in request.files:
+            feeds = parse_opml(request.files["file"].read())
+        elif request.mimetype in OPML_MIMETYPES:
+            feeds = parse_opml(request.get_data())
+        else:
+            feeds = request.get_json(silent=True)
+    except ParseError as e:
+        return jsonify(prepare_response(False, f"Invalid OPML document: {e}")), 400
+    if not isinstance(feeds, list):
+        return jsonify(prepare_response(False, "JSON array of feeds or OPML document is required")), 400
+    if len(feeds) > current_app.config["FEED_IMPORT_MAX_ROWS"]:
+        return jsonify(prepare_response(
+            False, f"Too many feeds, max {current_app.config['FEED_IMPORT_MAX_ROWS']} in one import")), 400
+
+    rows, valid = [], []
+    for row, feed in enumerate(feeds):
+        errors = import_feed_schema.validate(feed) if isinstance(feed, dict) else {"_schema": ["Invalid feed."]}
+        if errors:
+            rows.append({"row": row, "status": "invalid", "errors": errors})
+        else:
+            feed = import_feed_schema.load(feed)
+            rows.append({"row": row, "status": "conflict", "url": feed["url"]})
+            valid.append((rows[-1], feed))
+    created = import_feeds([feed for _, feed in valid]) if valid else {}
+    for result, feed in valid:
+        # the first row with name and url gets the created feed, its duplicates in the same import are conflicts
+        if (feed["name"], feed["url"]) in created:
+            result.update(status="created", id=created.pop((feed["name"], feed["url"])))
+    counts = Counter(result["status"] for result in rows)
+    return jsonify(prepare_response(True, {"created": counts["created"], "conflicts": counts["conflict"],
+                                           "invalid": counts["invalid"], "rows": rows})), 200
+
+
+@bp.post('/feeds/<feed_id>/unfollow')
 def unfollow_feed(feed_id):
     """
     Unfollow feed
@@ -113,10 +197,11 @@ def unfollow_feed(feed_id):
         return jsonify(prepare_response(False, no_feed_msg.format(feed_id))), 404
     db.session.delete(feed)
     db.session.commit()
+    response_cache.invalidate()
     return jsonify(prepare_response(True)), 200
 
 
-@app.post('/feeds/<feed_id>/set_active')
+@bp.post('/feeds/<feed_id>/set_active')
 def active_feed(feed_id):
     """
     Make feed active (turn on auto update items)
@@ -139,11 +224,14 @@ def active_feed(feed_id):
         return jsonify(prepare_response(False, no_feed_msg.format(feed_id))), 404
     feed.active = True
     feed.errors_count = 0
+    feed.next_poll_at = None
+    feed.next_retry_at = None
     db.session.commit()
+    response_cache.invalidate()
     return jsonify(prepare_response(True)), 200
 
 
-@app.post('/feeds/<feed_id>/set_inactive')
+@bp.post('/feeds/<feed_id>/set_inactive')
 def inactive_feed(feed_id):
     """
     Make feed inactive (turn off auto update items)
@@ -165,10 +253,12 @@ def inactive_feed(feed_id):
         return jsonify(prepare_response(False, no_feed_msg.format(feed_id))), 404
     feed.active = False
     db.session.commit()
+    response_cache.invalidate()
     return jsonify(prepare_response(True)), 200
 
 
-@app.get('/feeds')
+@bp.get('/feeds')
+@response_cache.cached
 def get_all_feeds():
     """
     Get information about all feeds
@@ -192,12 +282,12 @@ def get_all_feeds():
             schema:
                 $ref: '#/definitions/FeedsResponse'
     """
-    feeds = Feed.query.all()
-    feed_list = [feed.to_dict() for feed in feeds]
-    return jsonify(prepare_response(True, feed_list))
+    feeds = db.session.execute(db.select(*serialized_columns(Feed))).all()
+    return json_response(prepare_response(True, serialize_rows(Feed, feeds)))
 
 
-@app.get('/feeds/<feed_id>')
+@bp.get('/feeds/<feed_id>')
+@response_cache.cached
 def get_one_feed(feed_id):
     """
     Get information about one feed
@@ -228,6 +318,9 @@ def get_one_feed(feed_id):
                     type: string
                 last_updated:
                     type: string
+                next_poll_at:
+                    type: string
+                    description: When feed will be updated in background next time
     responses:
         200:
             description: Feed information
@@ -242,11 +335,14 @@ def get_one_feed(feed_id):
     return jsonify(prepare_response(True, feed.to_dict()))
 
 
-@app.get('/feeds/<feed_id>/items')
+@bp.get('/feeds/<feed_id>/items')
+@response_cache.cached
+@conditional_response
 @use_kwargs(get_all_items_schema, location="querystring")
-def get_feed_items(feed_id, unread=None):
+def get_feed_items(feed_id, unread=None, limit=None, after=None, stream=False):
     """
-     Get all items for feed
+     Get all items for feed (from newest to oldest), including the same articles stored from another feed
+     (their feed_id is the feed they were stored from)
      ---
      parameters:
        - name: id
@@ -261,6 +357,23 @@ def get_feed_items(feed_id, unread=None):
          type: boolean
          required: false
          example: true
+       - name: limit
+         description: Page size (1-1000). If not set - all items are returned
+         in: querystring
+         type: integer
+         required: false
+         example: 100
+       - name: after
+         description: Cursor from the "next" field of the previous page
+         in: querystring
+         type: string
+         required: false
+       - name: stream
+         description: Stream all matching items (pagination is not applied). Send "Accept: application/x-ndjson" to get one item per line
+         in: querystring
+         type: boolean
+         required: false
+         example: true
      definitions:
          FeedItemsResponse:
              type: object
@@ -269,6 +382,9 @@ def get_feed_items(feed_id, unread=None):
                      type: array
                      items:
                          $ref: '#/definitions/Item'
+                 next:
+                     type: string
+                     description: Cursor for the next page (only if limit is set), null on the last page
                  success:
                      type: boolean
          Item:
@@ -294,18 +410,21 @@ def get_feed_items(feed_id, unread=None):
          404:
              description: Feed with id not found
      """
+    query = Item.query.with_entities(*serialized_columns(Item)).filter(feed_items_filter(feed_id))
     if unread is not None:
-        result = Item.query.filter_by(feed_id=feed_id).filter_by(unread=unread).order_by(
-            Item.last_updated.desc()).all()
-    else:
-        result = Item.query.filter_by(feed_id=feed_id).order_by(
-            Item.last_updated.desc()).all()
+        query = query.filter_by(unread=unread)
+    ndjson = request.accept_mimetypes.best_match(["application/json", NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+    if stream or ndjson:
+        return stream_items(order_items(query, after), ndjson)
+    result, next_cursor = paginate_items(query, limit, after)
 
-    item_list = [item.to_dict() for item in result]
-    return jsonify(prepare_response(True, item_list))
+    item_list = serialize_rows(Item, result)
+    if limit is None:
+        return json_response(prepare_response(True, item_list))
+    return json_response(prepare_response(True, item_list, next=next_cursor))
 
 
-@app.post('/feeds/update')
+@bp.post('/feeds/update')
 def force_all_feeds_update():
     """
     Start all feeds update (including inactive)
@@ -318,7 +437,7 @@ def force_all_feeds_update():
     return jsonify(prepare_response(True)), 200
 
 
-@app.post('/feeds/<feed_id>/update')
+@bp.post('/feeds/<feed_id>/update')
 def force_feed_update(feed_id):
     """
     Force one feed update (not depend on activity)
@@ -1,15 +1,22 @@
-from flask import jsonify
+from flask import jsonify, request, Blueprint
 from webargs.flaskparser import use_args, use_kwargs
+from sqlalchemy import tuple_
 
-from app import app, db
+from app import db
+from app.cache import response_cache
 from app.models.Item import Item
-from app.validation_schemas import set_read_schema, get_all_items_schema
-from app.utils import prepare_response
+from app.serializer import json_response, serialize_rows, serialized_columns
+from app.validation_schemas import set_read_schema, get_all_items_schema, set_read_bulk_schema, \
+    get_item_changes_schema, search_items_schema
+from app.utils import prepare_response, paginate_items, order_items, stream_items, NDJSON_MIMETYPE, \
+    conditional_response, item_changes, search_items, feed_items_filter
+
+bp = Blueprint("items", __name__)
 
 no_item_msg = "Item with id {} not found"
 
 
-@app.patch('/items/<item_id>')
+@bp.patch('/items/<item_id>')
 @use_kwargs(set_read_schema)
 def set_read(item_id, unread):
     """
@@ -36,14 +43,80 @@ def set_read(item_id, unread):
     else:
         item.unread = False
     db.session.commit()
+    response_cache.invalidate()
     return jsonify(prepare_response(True)), 200
 
 
-@app.get('/items')
+@bp.patch('/items')
+@use_args(set_read_bulk_schema)
+def set_read_bulk(args):
+    """
+    Read/unread many items at once (e.g. "mark all as read") with one UPDATE.
+    At least one filter is required, all given filters are combined
+    ---
+    parameters:
+      - name: unread
+        in: body
+        type: boolean
+        required: true
+        example: false
+      - name: ids
+        description: List of item ids
+        in: body
+        type: array
+        items:
+            type: integer
+        required: false
+        example: [1, 2, 3]
+      - name: feed_id
+        description: All items of the feed (including the ones linked to it from another feed)
+        in: body
+        type: integer
+        required: false
+        example: 1
+      - name: older_than
+        description: All items updated before this time (ISO 8601)
+        in: body
+        type: string
+        required: false
+        example: "2023-03-10T15:17:35"
+      - name: after
+        description: All items after the cursor in listing order (the same cursor as "next" field of GET /items)
+        in: body
+        type: string
+        required: false
+    responses:
+        200:
+            description: Number of changed items
+            example: {success: true, message: {updated: 10}}
+        400:
+            description: No filter given
+    """
+    filters = []
+    if "ids" in args:
+        filters.append(Item.id.in_(args["ids"]))
+    if "feed_id" in args:
+        filters.append(feed_items_filter(args["feed_id"]))
+    if "older_than" in args:
+        filters.append(Item.last_updated < args["older_than"])
+    if "after" in args:
+        filters.append(tuple_(Item.last_updated, Item.id) < args["after"])
+    if not filters:
+        return jsonify(prepare_response(False, "ids, feed_id, older_than or after is required")), 400
+    updated = Item.query.filter(*filters, Item.unread.isnot(args["unread"])).update(
+        {Item.unread: args["unread"]}, synchronize_session=False)
+    db.session.commit()
+    response_cache.invalidate()
+    return jsonify(prepare_response(True, {"updated": updated})), 200
+
+
+@bp.get('/items')
+@response_cache.cached
+@conditional_response
 @use_args(get_all_items_schema, location="querystring")
 def get_all_items(args):
     """
-     List all items for all feeds
+     List all items for all feeds (from newest to oldest)
      ---
      parameters:
        - name: unread
@@ -52,24 +125,135 @@ def get_all_items(args):
          type: boolean
          required: false
          example: true
+       - name: limit
+         description: Page size (1-1000). If not set - all items are returned
+         in: querystring
+         type: integer
+         required: false
+         example: 100
+       - name: after
+         description: Cursor from the "next" field of the previous page
+         in: querystring
+         type: string
+         required: false
+       - name: stream
+         description: Stream all matching items (pagination is not applied). Send "Accept: application/x-ndjson" to get one item per line
+         in: querystring
+         type: boolean
+         required: false
+         example: true
      responses:
          200:
              description: List of items
              schema:
                  $ref: '#/definitions/FeedItemsResponse'
      """
+    query = Item.query.with_entities(*serialized_columns(Item))
     if "unread" in args:
-        items = Item.query.filter_by(unread=args["unread"]).order_by(
-            Item.last_updated.desc()).all()
-    else:
-        items = Item.query.order_by(Item.last_updated.desc()).all()
+        query = query.filter_by(unread=args["unread"])
+    ndjson = request.accept_mimetypes.best_match(["application/json", NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+    if args.get("stream") or ndjson:
+        return stream_items(order_items(query, args.get("after")), ndjson)
+    items, next_cursor = paginate_items(query, args.get("limit"), args.get("after"))
+
+    item_list = serialize_rows(Item, items)
+
+    if "limit" not in args:
+        return json_response(prepare_response(True, item_list)), 200
+    return json_response(prepare_response(True, item_list, next=next_cursor)), 200
+
+
+@bp.get('/items/changes')
+@use_kwargs(get_item_changes_schema, location="querystring")
+def get_item_changes(since=None, limit=None):
+    """
+     Items created or updated since the cursor (delta sync).
+     Start without cursor, then poll with the "next" cursor of the previous response
+     ---
+     parameters:
+       - name: since
+         description: Cursor from the "next" field of the previous response
+         in: querystring
+         type: string
+         required: false
+       - name: limit
+         description: Max number of items (1-1000)
+         in: querystring
+         type: integer
+         required: false
+         default: 500
+     definitions:
+         ItemChangesResponse:
+             type: object
+             properties:
+                 message:
+                     type: array
+                     items:
+                         $ref: '#/definitions/Item'
+                 next:
+                     type: string
+                     description: Cursor to poll next changes with (the same as "since" if there are no changes)
+                 success:
+                     type: boolean
+     responses:
+         200:
+             description: Changed items in order of changes
+             schema:
+                 $ref: '#/definitions/ItemChangesResponse'
+     """
+    items, next_cursor = item_changes(since, limit)
+    return json_response(prepare_response(True, serialize_rows(Item, items), next=next_cursor)), 200
 
-    item_list = [item.to_dict() for item in items]
 
-    return jsonify(prepare_response(True, item_list)), 200
+@bp.get('/items/search')
+@use_kwargs(search_items_schema, location="querystring")
+def search(q, limit, offset):
+    """
+     Full-text search over item titles, best matches first
+     ---
+     parameters:
+       - name: q
+         description: Search query
+         in: querystring
+         type: string
+         required: true
+         example: nintendo
+       - name: limit
+         description: Page size (1-100)
+         in: querystring
+         type: integer
+         required: false
+         default: 20
+       - name: offset
+         description: Offset from the "next" field of the previous page (up to 1000)
+         in: querystring
+         type: integer
+         required: false
+         default: 0
+     definitions:
+         SearchResponse:
+             type: object
+             properties:
+                 message:
+                     type: array
+                     items:
+                         $ref: '#/definitions/Item'
+                 next:
+                     type: integer
+                     description: Offset of the next page, null on the last page
+                 success:
+                     type: boolean
+     responses:
+         200:
+             description: Found items
+             schema:
+                 $ref: '#/definitions/SearchResponse'
+     """
+    items, next_offset = search_items(q, limit, offset)
+    return jsonify(prepare_response(True, [item.to_dict() for item in items], next=next_offset)), 200
 
 
-@app.get('/items/<item_id>')
+@bp.get('/items/<item_id>')
 def get_one_item(item_id):
     """
      Get one item by id
@@ -0,0 +1,17 @@
+from flask import Blueprint
+
+from app.metrics import metrics_response
+
+bp = Blueprint("metrics", __name__)
+
+
+@bp.get('/metrics')
+def get_metrics():
+    """
+    Prometheus metrics (API request latency; ingestion metrics too if worker shares PROMETHEUS_MULTIPROC_DIR)
+    ---
+    responses:
+        200:
+            description: Metrics in Prometheus text format
+    """
+    return metrics_response()
@@ -0,0 +1,4 @@
+"""
+Offline ingestion benchmark: synthetic feeds (bench.feeds) served by a local HTTP server (bench.server)
+and a runner (python -m bench) which measures update_feed / update_feeds against SQLite or PostgreSQL.
+"""
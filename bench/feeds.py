@@ -0,0 +1,56 @@
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from xml.sax.saxutils import escape
+
+# Entries are published every PUBLISH_STEP from BASE_TIME back in time
+BASE_TIME = datetime(2023, 3, 13, 12, 0, 0)
+PUBLISH_STEP = timedelta(minutes=10)
+
+
+def entry_values(feed_no, entry_no):
+    """
+    Deterministic values of one entry, so a runner can seed the database with the same items (overlap)
+    """
+    return {
+        "remote_id": f"urn:bench:{feed_no}:{entry_no}",
+        "title": f"Benchmark feed {feed_no} entry {entry_no}",
+        "url": f"https://bench.example.com/{feed_no}/{entry_no}.html",
+        "published": BASE_TIME - PUBLISH_STEP * entry_no,
+    }
+
+
+def rss_entry(values):
+    return (f"<item><title>{escape(values['title'])}</title><link>{escape(values['url'])}</link>"
+            f"<guid>{escape(values['remote_id'])}</guid>"
+            f"<pubDate>{format_datetime(values['published'].replace(tzinfo=timezone.utc), usegmt=True)}</pubDate>"
+            f"<description>{'Lorem ipsum dolor sit amet. ' * 10}</description></item>")
+
+
+def atom_entry(values):
+    return (f"<entry><title>{escape(values['title'])}</title><link href=\"{escape(values['url'])}\"/>"
+            f"<id>{escape(values['remote_id'])}</id>"
+            f"<updated>{values['published'].isoformat()}Z</updated>"
+            f"<summary>{'Lorem ipsum dolor sit amet. ' * 10}</summary></entry>")
+
+
+def generate_feed(feed_no, entries, feed_format="rss"):
+    """
+    :param feed_no: Number of the feed, makes titles, urls and ids unique between feeds
+    :param entries: Number of entries, from newest to oldest
+    :param feed_format: rss (2.0) or atom
+    :return: Document bytes
+    """
+    items = [entry_values(feed_no, entry_no) for entry_no in range(entries)]
+    if feed_format == "atom":
+        body = "".join(atom_entry(values) for values in items)
+        document = (f'<?xml version="1.0" encoding="utf-8"?><feed xmlns="http://www.w3.org/2005/Atom">'
+                    f'<title>Benchmark feed {feed_no}</title><id>urn:bench:{feed_no}</id>'
+                    f'<updated>{BASE_TIME.isoformat()}Z</updated>{body}</feed>')
+    elif feed_format == "rss":
+        body = "".join(rss_entry(values) for values in items)
+        document = (f'<?xml version="1.0" encoding="utf-8"?><rss version="2.0"><channel>'
+                    f'<title>Benchmark feed {feed_no}</title><link>https://bench.example.com/{feed_no}</link>'
+                    f'{body}</channel></rss>')
+    else:
+        raise ValueError(f"Invalid feed format {feed_format}")
+    return document.encode()
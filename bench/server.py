@@ -0,0 +1,77 @@
+import gzip
+import threading
+import time
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from bench.feeds import generate_feed
+
+
+class FeedServer:
+    """
+    Local HTTP server with generated feeds on /<feed_no>.xml.
+    Supports gzip, ETag / If-None-Match (304) and an artificial response delay.
+    """
+
+    def __init__(self, feeds, entries, feed_format="rss", delay=0.0):
+        self.documents = {f"/{feed_no}.xml": generate_feed(feed_no, entries, feed_format) for feed_no in range(feeds)}
+        self.compressed = {path: gzip.compress(document) for path, document in self.documents.items()}
+        self.delay = delay
+        self.last_modified = formatdate(usegmt=True)
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    def url(self, feed_no):
+        return f"{self.base_url}/{feed_no}.xml"
+
+    def handler(self):
+        feed_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                if feed_server.delay:
+                    time.sleep(feed_server.delay)
+                if self.path not in feed_server.documents:
+                    self.send_error(404)
+                    return
+                etag = f'"{self.path}"'
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                if "gzip" in self.headers.get("Accept-Encoding", ""):
+                    body = feed_server.compressed[self.path]
+                else:
+                    body = feed_server.documents[self.path]
+                self.send_response(200)
+                self.send_header("Content-Type", "application/rss+xml; charset=utf-8")
+                if body is feed_server.compressed[self.path]:
+                    self.send_header("Content-Encoding", "gzip")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("ETag", etag)
+                self.send_header("Last-Modified", feed_server.last_modified)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
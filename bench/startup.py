@@ -0,0 +1,58 @@
+"""
+Cold start time of the API and the worker: every sample is a new interpreter which imports and creates the app.
+
+    python -m bench.startup --runs 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+TARGETS = {
+    "api": "from app import create_app; create_app()",
+    "worker": "import worker.tasks",
+}
+
+SAMPLE = """
+import time
+started = time.perf_counter()
+{code}
+print(time.perf_counter() - started)
+"""
+
+
+def measure(code, runs, env):
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", SAMPLE.format(code=code)], env=env, check=True,
+                                capture_output=True, text=True).stdout
+        samples.append(float(output.split()[-1]))
+    return samples
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench.startup", description="Cold start benchmark")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args(argv)
+
+    env = dict(os.environ)
+    env.setdefault("SQLALCHEMY_DATABASE_URI", f"sqlite:///{tempfile.mkdtemp(prefix='rss-bench-')}/startup.db")
+    results = []
+    for target, code in TARGETS.items():
+        samples = measure(code, args.runs, env)
+        results.append({"target": target, "runs": args.runs, "median_ms": round(statistics.median(samples) * 1000, 1),
+                        "max_ms": round(max(samples) * 1000, 1)})
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            print(" ".join(f"{key}={value}" for key, value in result.items()))
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -14,6 +14,20 @@ class Config:
     __defaults = {
         "MAX_RETRIES": 3,
         "SCHEDULE_INTERVAL_SEC": 10,
+        "FETCH_CONCURRENCY": 16,
+        "FETCH_PER_HOST_CONCURRENCY": 2,
+        "CLAIM_BATCH_SIZE": 100,
+        "FEED_LEASE_SEC": 300,
+        "RETRY_BASE_SEC": 60,
+        "RETRY_MAX_SEC": 3600,
+        "CIRCUIT_FAILURE_THRESHOLD": 5,
+        "CIRCUIT_OPEN_SEC": 300,
+        "CIRCUIT_MAX_OPEN_SEC": 3600,
+        "WORKER_METRICS_PORT": 0,
+        "RETENTION_MAX_AGE_DAYS": 0,
+        "RETENTION_MAX_ITEMS_PER_FEED": 0,
+        "RETENTION_BATCH_SIZE": 1000,
+        "RETENTION_INTERVAL_SEC": 3600,
         "CELERY_BROKER_URL": "redis://localhost:6379/0",
         "SMTP_SERVER": "",
         "SMTP_PORT": 587,
@@ -21,8 +35,17 @@ class Config:
         "SMTP_PASSWORD": "",
         "NOTIFICATION": False,
         "NOTIFICATION_TYPE": "email",
+        "DIGEST_WINDOW_SEC": 0,
+        "NOTIFICATION_INTERVAL_SEC": 30,
+        "NOTIFICATION_BATCH_SIZE": 100,
+        "NOTIFICATION_MAX_ATTEMPTS": 5,
     }
-    __integer_keys = ("MAX_RETRIES", "SCHEDULE_INTERVAL_SEC", "SMTP_PORT")
+    __integer_keys = ("MAX_RETRIES", "SCHEDULE_INTERVAL_SEC", "FETCH_CONCURRENCY", "FETCH_PER_HOST_CONCURRENCY",
+                      "CLAIM_BATCH_SIZE", "FEED_LEASE_SEC", "WORKER_METRICS_PORT", "SMTP_PORT",
+                      "DIGEST_WINDOW_SEC", "NOTIFICATION_INTERVAL_SEC", "NOTIFICATION_BATCH_SIZE",
+                      "NOTIFICATION_MAX_ATTEMPTS", "RETENTION_MAX_AGE_DAYS", "RETENTION_MAX_ITEMS_PER_FEED",
+                      "RETENTION_BATCH_SIZE", "RETENTION_INTERVAL_SEC", "RETRY_BASE_SEC", "RETRY_MAX_SEC",
+                      "CIRCUIT_FAILURE_THRESHOLD", "CIRCUIT_OPEN_SEC", "CIRCUIT_MAX_OPEN_SEC")
     __boolean_keys = ("NOTIFICATION",)
 
     __config = {}
@@ -0,0 +1,107 @@
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlsplit
+
+import requests
+from flask import current_app, has_app_context
+
+from app.utils import fetch_feed
+
+
+class HostCircuitOpen(Exception):
+    """
+    Feed isn't fetched because circuit breaker of its host is open (see app.models.HostHealth)
+    """
+
+    def __init__(self, host, opened_until):
+        super().__init__(f"Circuit of host {host} is open until {opened_until}")
+        self.host = host
+        self.opened_until = opened_until
+
+
+def is_host_failure(error):
+    """
+    Errors which say that the host (not the feed) is broken: connection errors, timeouts, 5xx and 429 responses
+    """
+    if isinstance(error, requests.HTTPError):
+        return error.response is not None and (error.response.status_code >= 500 or error.response.status_code == 429)
+    return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+
+class ConcurrentFetcher:
+    """
+    Fetch stage of the background update. Downloads feeds in a thread pool, so one sweep
+    takes about as long as the slowest host, not as the sum of all fetches.
+
+    Global concurrency is limited by the pool size. Per host concurrency is limited by the scheduler:
+    a feed is submitted to the pool only when its host has a free slot, so feeds of one busy host
+    never occupy all pool threads and don't block feeds of other hosts.
+    """
+
+    def __init__(self, concurrency, per_host_concurrency):
+        self.concurrency = max(1, concurrency)
+        self.per_host_concurrency = max(1, per_host_concurrency)
+
+    @staticmethod
+    def host(url):
+        return (urlsplit(url).hostname or "").lower()
+
+    @staticmethod
+    def fetch_in_context(app, url, *fetch_args):
+        """
+        Pool threads don't have the caller's application context, fetch_feed reads its limits from app config
+        """
+        if app is None:
+            return fetch_feed(url, *fetch_args)
+        with app.app_context():
+            return fetch_feed(url, *fetch_args)
+
+    def fetch_many(self, feeds, open_until=None, heartbeat=None, heartbeat_sec=None):
+        """
+        :param feeds: iterable of tuples (feed_id, url, *fetch_args), fetch_args are passed to fetch_feed
+        :param open_until: Function host -> datetime until which circuit of the host is open (or None).
+                           It's checked right before every fetch, so when the circuit opens in the middle
+                           of the sweep, the rest of the host's feeds aren't fetched (HostCircuitOpen is yielded)
+        :param heartbeat: Function which is called every heartbeat_sec while feeds are fetched
+                          (in the caller's thread, between results), e.g. to renew leases of the feeds
+        :return: generator of tuples (feed_id, parsed feed, exception) in order of completion.
+                 Exactly one of parsed feed and exception is None
+        """
+        pending = {}
+        for feed_id, url, *fetch_args in feeds:
+            pending.setdefault(self.host(url), deque()).append((feed_id, url, fetch_args))
+
+        app = current_app._get_current_object() if has_app_context() else None
+        running = Counter()
+        active = {}
+        next_heartbeat = time.monotonic() + heartbeat_sec if heartbeat else None
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while pending or active:
+                for host in list(pending):
+                    queue = pending[host]
+                    while queue and running[host] < self.per_host_concurrency and len(active) < self.concurrency:
+                        feed_id, url, fetch_args = queue.popleft()
+                        opened_until = open_until(host) if open_until else None
+                        if opened_until:
+                            yield feed_id, None, HostCircuitOpen(host, opened_until)
+                            continue
+                        active[executor.submit(self.fetch_in_context, app, url, *fetch_args)] = (feed_id, host)
+                        running[host] += 1
+                    if not queue:
+                        del pending[host]
+
+                if heartbeat and time.monotonic() >= next_heartbeat:
+                    heartbeat()
+                    next_heartbeat = time.monotonic() + heartbeat_sec
+                if not active:
+                    continue
+                timeout = max(0.0, next_heartbeat - time.monotonic()) if heartbeat else None
+                done, _ = wait(active, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    feed_id, host = active.pop(future)
+                    running[host] -= 1
+                    try:
+                        yield feed_id, future.result(), None
+                    except Exception as e:
+                        yield feed_id, None, e
@@ -1,11 +1,16 @@
+import logging
 import smtplib
+import threading
+import time
+from collections import OrderedDict
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
-from app import app
 from worker.Config import Config
 
 config = Config().get_config()
+# not the flask app logger: notifications can be sent outside of application context
+logger = logging.getLogger(__name__)
 
 
 class NotificationFactory:
@@ -23,38 +28,116 @@ class NotificationFactory:
         else:
             raise ValueError('Invalid notification type')
 
+    @staticmethod
+    def create_dispatcher(notification_type):
+        if notification_type == 'email':
+            return EmailDispatcher(digest_window=config["DIGEST_WINDOW_SEC"])
+        else:
+            raise ValueError('Invalid notification type')
 
-class EmailNotification(NotificationFactory):
-    host = config["SMTP_SERVER"]
-    port = config["SMTP_PORT"]
-    login = config["SMTP_LOGIN"]
-    password = config["SMTP_PASSWORD"]
 
+def smtp_connection():
+    """
+    Opens authenticated SMTP connection with settings from the config
+    """
+    s = smtplib.SMTP(host=config["SMTP_SERVER"], port=int(config["SMTP_PORT"]))
+    s.starttls()
+    s.login(config["SMTP_LOGIN"], config["SMTP_PASSWORD"])
+    return s
+
+
+def email_message(sender, recipient, messages):
+    """
+    :param messages: Texts of notifications, several ones are sent as a digest
+    """
+    msg = MIMEMultipart()
+    msg['From'] = sender
+    msg['To'] = recipient
+    if len(messages) == 1:
+        msg['Subject'] = "Alert from RSS Scraper Notifier"
+    else:
+        msg['Subject'] = f"{len(messages)} alerts from RSS Scraper Notifier"
+    msg.attach(MIMEText("\n\n".join(messages), 'plain'))
+    return msg
+
+
+class EmailNotification(NotificationFactory):
     def __init__(self, recipient, message):
         self.recipient = recipient
         self.message = message
 
     def send_notification(self):
-        app.logger.info(f'Creating notification for {self.recipient}')
-        s = smtplib.SMTP(host=self.host, port=int(self.port))
-        s.starttls()
-        s.login(self.login, self.password)
+        logger.info(f'Creating notification for {self.recipient}')
+        dispatcher = EmailDispatcher()
+        dispatcher.add(self.recipient, self.message)
+        dispatcher.flush()
+
 
-        msg = MIMEMultipart()  # create a message
+class EmailDispatcher:
+    """
+    Collects email notifications and sends them by batches over one authenticated SMTP connection.
+    Notifications for the same recipient within digest_window seconds (counted from the first one)
+    are merged into one digest email.
+    """
 
-        # setup the parameters of the message
-        msg['From'] = self.login
+    def __init__(self, digest_window=0, smtp_factory=smtp_connection, sender=None):
+        """
+        :param smtp_factory: Callable which returns connected and logged in smtplib.SMTP-like object
+        """
+        self.digest_window = digest_window
+        self.smtp_factory = smtp_factory
+        self.sender = sender or config["SMTP_LOGIN"]
+        # recipient -> (time of the first pending notification, list of messages)
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
 
-        msg['To'] = self.recipient
-        msg['Subject'] = "Alert from RSS Scraper Notifier"
+    def add(self, recipient, message):
+        with self._lock:
+            if recipient not in self._pending:
+                self._pending[recipient] = (time.monotonic(), [])
+            self._pending[recipient][1].append(message)
+
+    def pending_recipients(self):
+        with self._lock:
+            return set(self._pending)
+
+    def clear(self):
+        with self._lock:
+            self._pending.clear()
 
-        # add in the message body
-        msg.attach(MIMEText(self.message, 'plain'))
+    def pending(self):
+        with self._lock:
+            return sum(len(messages) for _, messages in self._pending.values())
 
-        # send the message via the server set up earlier.
-        s.send_message(msg)
-        app.logger.info(f'Notification with text {msg} sent to {self.recipient}')
-        del msg
+    def flush(self, force=False):
+        """
+        Sends notifications whose digest window is over (all of them if force).
+        If connection fails, unsent notifications stay pending for the next flush.
+        :return: Number of sent emails
+        """
+        now = time.monotonic()
+        with self._lock:
+            ready = [(recipient, started, messages) for recipient, (started, messages) in self._pending.items()
+                     if force or now - started >= self.digest_window]
+            for recipient, _, _ in ready:
+                del self._pending[recipient]
+        if not ready:
+            return 0
 
-        # Terminate the SMTP session and close the connection
-        s.quit()
+        sent = 0
+        try:
+            s = self.smtp_factory()
+            try:
+                for recipient, _, messages in ready:
+                    s.send_message(email_message(self.sender, recipient, messages))
+                    logger.info(f'Notification with {len(messages)} alert(s) sent to {recipient}')
+                    sent += 1
+            finally:
+                s.quit()
+        except Exception:
+            with self._lock:
+                for recipient, started, messages in ready[sent:]:
+                    _, newer = self._pending.pop(recipient, (started, []))
+                    self._pending[recipient] = (started, messages + newer)
+            raise
+        return sent
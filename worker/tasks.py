@@ -1,57 +1,232 @@
+import os
+import random
+import socket
 from celery import Celery
-from datetime import timedelta
+from celery.signals import worker_ready
+from collections import defaultdict
+from datetime import datetime, timedelta
+from prometheus_client import start_http_server
 
-from app import app, db
+from app import create_app, db
+from app import metrics
+from app.cache import response_cache
 from app.models.Feed import Feed
-from app.utils import update_feed
+from app.models.HostHealth import HostHealth
+from app.models.Notification import Notification
+from app.utils import update_feed, insert_ignore, archive_items
+from worker.fetcher import ConcurrentFetcher, HostCircuitOpen, is_host_failure
 from worker.notifyer import NotificationFactory
 from worker.Config import Config
 
 config = Config().get_config()
+# the worker doesn't serve API docs, the schema is created by "flask --app wsgi init-db"
+app = create_app({"SWAGGER_ENABLED": False})
 celery = Celery(app.name, broker=config["CELERY_BROKER_URL"])
 
 celery.conf.beat_schedule["update_feeds"] = {'task': 'worker.tasks.update_feeds',
                                              "schedule": timedelta(seconds=config["SCHEDULE_INTERVAL_SEC"])}
+celery.conf.beat_schedule["archive_expired_items"] = {'task': 'worker.tasks.archive_expired_items',
+                                                      "schedule": timedelta(seconds=config["RETENTION_INTERVAL_SEC"])}
+
+# Notifications are sent from the outbox by their own task and queue, so SMTP latency doesn't slow down updates.
+# Run a worker for this queue: celery -A worker.celery worker -Q notifications
+celery.conf.task_routes = {"worker.tasks.drain_notifications": {"queue": "notifications"}}
+if config["NOTIFICATION"]:
+    celery.conf.beat_schedule["drain_notifications"] = {
+        'task': 'worker.tasks.drain_notifications',
+        "schedule": timedelta(seconds=config["NOTIFICATION_INTERVAL_SEC"])}
+
+
+@worker_ready.connect
+def start_metrics_server(**kwargs):
+    """
+    Worker metrics are served on their own port. Set PROMETHEUS_MULTIPROC_DIR to collect metrics of prefork children
+    """
+    if config["WORKER_METRICS_PORT"]:
+        start_http_server(config["WORKER_METRICS_PORT"], registry=metrics.registry())
+
+
+def worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
 
 
 @celery.task(max_retries=config["MAX_RETRIES"], retry_backoff=True, retry_backoff_max=5)
 def update_feeds():
     """
-    Takes all active feeds and trying to update each one.
+    Claims batches of active due feeds (see Feed.next_poll_at and Feed.claim_due), from the most overdue,
+    and trying to update each one. Several workers (or overlapping sweeps) share the work by leases
+    instead of fetching the same feeds.
+    Feeds are downloaded concurrently (see @ConcurrentFetcher), every downloaded feed is saved
+    to the database as soon as it's ready, while the rest are still being fetched.
     If feed fails - call @retry_fail_feed to retry or fail it
     """
-    with app.app_context():
-        feeds_for_update = Feed.query.filter_by(active=True).all()
-        for feed in feeds_for_update:
-            try:
-                update_feed(feed.id)
-            except Exception as e:
-                app.logger.warning(f'Something wrong with feed {feed.name}\n Error: {e}')
-                retry_fail_feed(feed.id)
+    owner = worker_id()
+    fetcher = ConcurrentFetcher(config["FETCH_CONCURRENCY"], config["FETCH_PER_HOST_CONCURRENCY"])
+    claimed = []
+    with app.app_context(), metrics.SWEEP_SECONDS.time():
+        try:
+            while True:
+                feeds_for_update = Feed.claim_due(owner, config["CLAIM_BATCH_SIZE"], config["FEED_LEASE_SEC"])
+                if not feeds_for_update:
+                    break
+                now = datetime.utcnow()
+                for feed in feeds_for_update:
+                    if feed.next_poll_at:
+                        metrics.QUEUE_LAG_SECONDS.observe((now - feed.next_poll_at).total_seconds())
+                claimed += [feed.id for feed in feeds_for_update]
+                update_feeds_batch(feeds_for_update, fetcher, owner)
+        finally:
+            # failed feeds stay due, but they are released only now, so they aren't claimed again in this sweep
+            db.session.rollback()
+            if claimed:
+                Feed.release_leases(claimed, owner)
     return True
 
 
+def update_feeds_batch(feeds_for_update, fetcher, owner):
+    """
+    Fetches and saves one claimed batch. Host failures (see @is_host_failure) feed the circuit breaker
+    of the host (see @HostHealth): while it's open, the host's feeds are skipped without a request
+    and without counting an error, they wait until the circuit can be probed again.
+    A batch with slow hosts can take longer than FEED_LEASE_SEC, so leases of the feeds which aren't
+    processed yet are renewed every third of the lease.
+    """
+    names = {feed.id: feed.name for feed in feeds_for_update}
+    remaining = set(names)
+    hosts = {feed.id: fetcher.host(feed.url) for feed in feeds_for_update}
+    health = HostHealth.failing(set(hosts.values()))
+    skipped = defaultdict(list)
+
+    def open_until(host):
+        opened_until = health.get(host)
+        return opened_until if opened_until and opened_until > datetime.utcnow() else None
+
+    def renew_leases():
+        if remaining:
+            Feed.renew_leases(remaining, owner, config["FEED_LEASE_SEC"])
+
+    for feed_id, feedparsed, error in fetcher.fetch_many(
+            ((feed.id, feed.url, feed.etag, feed.modified, feed.high_water_mark) for feed in feeds_for_update),
+            open_until, renew_leases, config["FEED_LEASE_SEC"] / 3):
+        remaining.discard(feed_id)
+        if isinstance(error, HostCircuitOpen):
+            metrics.SWEEP_FEEDS.labels("skipped").inc()
+            skipped[error.opened_until].append(feed_id)
+            continue
+        host = hosts[feed_id]
+        if error and is_host_failure(error):
+            health[host] = HostHealth.record_failure(host, config["CIRCUIT_FAILURE_THRESHOLD"],
+                                                     config["CIRCUIT_OPEN_SEC"], config["CIRCUIT_MAX_OPEN_SEC"])
+            if health[host]:
+                app.logger.warning(f'Circuit of host {host} is open until {health[host]}')
+        elif host in health:
+            HostHealth.record_success(host)
+            del health[host]
+        try:
+            if error:
+                raise error
+            update_feed(feed_id, feedparsed)
+            metrics.SWEEP_FEEDS.labels("updated").inc()
+        except Exception as e:
+            metrics.SWEEP_FEEDS.labels("failed").inc()
+            app.logger.warning(f'Something wrong with feed {names[feed_id]}\n Error: {e}')
+            db.session.rollback()
+            retry_fail_feed(feed_id)
+    for opened_until, feed_ids in skipped.items():
+        Feed.query.filter(Feed.id.in_(feed_ids)).update({Feed.next_retry_at: opened_until}, synchronize_session=False)
+    if skipped:
+        db.session.commit()
+
+
 def retry_fail_feed(feed_id):
     """
     Checks that the number of errors for this feed has not exceeded the value of the variable MAX_RETRIES.
-    If it did, makes it inactive and trying to send notification.
+    If it did, makes it inactive and puts notification to the outbox (in the same transaction).
+    Otherwise the feed is retried after exponential backoff with full jitter, so feeds which failed
+    together aren't retried together.
     """
     with app.app_context():
         failed = Feed.query.filter_by(id=feed_id).one()
         if failed.errors_count >= config["MAX_RETRIES"]:
             app.logger.info(f'Deactivating feed {failed.name} with id {failed.id} due to errors')
             failed.active = False
-            db.session.commit()
             if config["NOTIFICATION"] and failed.owner_email:
-                NotificationFactory.create_notification(config["NOTIFICATION_TYPE"],
-                                                        "MS_3Ew0Os@shatalov.it",
-                                                        f"Auto update from feed {failed.name} turned off due to errors"
-                                                        # failed.owner_email,
-                                                        ).send_notification()
-
+                now = datetime.utcnow()
+                insert_ignore(Notification, [{
+                    "dedup_key": f"feed_deactivated:{failed.id}:{now:%Y-%m-%d}",
+                    "recipient": failed.owner_email,
+                    "message": f"Auto update from feed {failed.name} turned off due to errors",
+                    "created_at": now,
+                }])
+            db.session.commit()
+            response_cache.invalidate()
             return True
         else:
             failed.errors_count += 1
+            backoff = min(config["RETRY_MAX_SEC"], config["RETRY_BASE_SEC"] * 2 ** failed.errors_count)
+            failed.next_retry_at = datetime.utcnow() + timedelta(seconds=random.uniform(0, backoff))
             app.logger.info(f'Feed {failed.name} with id {failed.id} update failed {failed.errors_count} time')
             db.session.commit()
+            response_cache.invalidate()
             return False
+
+
+@celery.task
+def archive_expired_items():
+    """
+    Moves items which are expired by retention policy to the archive table (see @archive_items)
+    """
+    with app.app_context():
+        return archive_items(config["RETENTION_MAX_AGE_DAYS"], config["RETENTION_MAX_ITEMS_PER_FEED"],
+                             config["RETENTION_BATCH_SIZE"])
+
+
+@celery.task(max_retries=config["MAX_RETRIES"], retry_backoff=True)
+def drain_notifications():
+    """
+    Sends pending notifications from the outbox by batches (one SMTP connection per batch)
+    """
+    dispatcher = NotificationFactory.create_dispatcher(config["NOTIFICATION_TYPE"])
+    sent = 0
+    while True:
+        sent_batch, claimed = drain_outbox(dispatcher, config["NOTIFICATION_BATCH_SIZE"])
+        sent += sent_batch
+        if claimed < config["NOTIFICATION_BATCH_SIZE"]:
+            return sent
+
+
+def drain_outbox(dispatcher, limit):
+    """
+    Sends one batch of ready notifications, notifications of one recipient are merged into a digest.
+    Sent notifications are marked by sent_at, failed ones are retried with exponential backoff.
+    :return: (number of sent notifications, number of claimed notifications)
+    """
+    with app.app_context():
+        claimed = Notification.claim_ready(limit, config["NOTIFICATION_MAX_ATTEMPTS"], config["DIGEST_WINDOW_SEC"])
+        by_recipient = defaultdict(list)
+        for notification in claimed:
+            by_recipient[notification.recipient].append(notification)
+            dispatcher.add(notification.recipient, notification.message)
+        error = None
+        try:
+            dispatcher.flush(force=True)
+        except Exception as e:
+            error = e
+            app.logger.warning(f'Notifications are not sent\n Error: {e}')
+        unsent = dispatcher.pending_recipients()
+        dispatcher.clear()
+
+        now = datetime.utcnow()
+        sent = 0
+        for recipient, notifications in by_recipient.items():
+            for notification in notifications:
+                if recipient in unsent:
+                    notification.attempts += 1
+                    notification.last_error = str(error)
+                    notification.next_attempt_at = now + timedelta(
+                        seconds=min(config["NOTIFICATION_INTERVAL_SEC"] * 2 ** notification.attempts, 3600))
+                else:
+                    notification.sent_at = now
+                    sent += 1
+        db.session.commit()
+        return sent, len(claimed)
@@ -1,3 +1,10 @@
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+import feedparser
+import requests
 from pytest import raises
 
 from celery.exceptions import Retry
@@ -5,7 +12,11 @@ from app.models.Feed import Feed
 # for python 2: use mock.patch from `pip install mock`.
 from unittest.mock import patch
 from app import app, db
-from worker.tasks import update_feeds
+from app.models.HostHealth import HostHealth
+from app.models.Notification import Notification
+from worker.tasks import update_feeds, retry_fail_feed, drain_outbox
+from worker.fetcher import ConcurrentFetcher
+from worker.notifyer import EmailDispatcher
 
 TEST_FEED_OK = {"name": "feedburner",
                 "url": "https://feeds.feedburner.com/tweakers/mixed",
@@ -16,6 +27,37 @@ TEST_FEED_BROKEN = {"name": "broken_feed",
                     "owner_email": "ilya@shatalov.it"}
 
 
+def test_fetcher_limits():
+    lock = threading.Lock()
+    running = Counter()
+    max_running = Counter()
+
+    def fake_fetch(url):
+        host = ConcurrentFetcher.host(url)
+        with lock:
+            running[host] += 1
+            running["total"] += 1
+            max_running[host] = max(max_running[host], running[host])
+            max_running["total"] = max(max_running["total"], running["total"])
+        time.sleep(0.01)
+        with lock:
+            running[host] -= 1
+            running["total"] -= 1
+        if "broken" in url:
+            raise ValueError(url)
+        return url
+
+    feeds = [(i, f"https://host{i % 3}.example.com/{i}") for i in range(30)] + [(30, "https://broken.example.com")]
+    with patch("worker.fetcher.fetch_feed", fake_fetch):
+        results = list(ConcurrentFetcher(4, 1).fetch_many(feeds))
+
+    assert len(results) == len(feeds)
+    assert {feed_id for feed_id, _, _ in results} == {feed_id for feed_id, _ in feeds}
+    assert [feed_id for feed_id, _, error in results if error] == [30]
+    assert max_running["total"] <= 4
+    assert max(max_running[f"host{i}.example.com"] for i in range(3)) == 1
+
+
 def test_success(celery_app, celery_worker):
     test_feed_ok = Feed(**TEST_FEED_OK)
     test_feed_broken = Feed(**TEST_FEED_BROKEN)
@@ -42,3 +84,169 @@ def test_success(celery_app, celery_worker):
     #
     #     with raises(Retry):
     #         send_order(product.pk, 3, Decimal(30.6))
+
+
+class FakeSMTP:
+    connections = []
+
+    def __init__(self):
+        self.sent = []
+        self.closed = False
+        FakeSMTP.connections.append(self)
+
+    def send_message(self, msg):
+        self.sent.append(msg)
+
+    def quit(self):
+        self.closed = True
+
+
+def test_email_dispatcher():
+    FakeSMTP.connections = []
+    dispatcher = EmailDispatcher(smtp_factory=FakeSMTP, sender="rss@example.com")
+    for i in range(3):
+        dispatcher.add("first@example.com", f"Feed {i} turned off")
+    dispatcher.add("second@example.com", "Feed 3 turned off")
+    assert dispatcher.flush() == 2
+    assert dispatcher.flush() == 0
+
+    assert len(FakeSMTP.connections) == 1
+    connection = FakeSMTP.connections[0]
+    assert connection.closed
+    assert [msg["To"] for msg in connection.sent] == ["first@example.com", "second@example.com"]
+    digest = connection.sent[0].get_payload()[0].get_payload()
+    assert all(f"Feed {i} turned off" in digest for i in range(3))
+
+    # within the digest window notifications are kept until forced flush
+    dispatcher = EmailDispatcher(digest_window=3600, smtp_factory=FakeSMTP)
+    dispatcher.add("first@example.com", "Feed 4 turned off")
+    assert dispatcher.flush() == 0
+    assert dispatcher.pending() == 1
+    assert dispatcher.flush(force=True) == 1
+    assert dispatcher.pending() == 0
+
+
+class BrokenSMTP(FakeSMTP):
+    def send_message(self, msg):
+        raise ConnectionError("SMTP is down")
+
+
+def test_notification_outbox():
+    with app.app_context():
+        db.create_all()
+        feed = Feed(**TEST_FEED_BROKEN)
+        feed.errors_count = 100
+        db.session.add(feed)
+        db.session.commit()
+        feed_id = feed.id
+    try:
+        with patch.dict("worker.tasks.config", NOTIFICATION=True):
+            assert retry_fail_feed(feed_id)
+            # deactivated again the same day - notification is not duplicated
+            assert retry_fail_feed(feed_id)
+
+        assert drain_outbox(EmailDispatcher(smtp_factory=BrokenSMTP), 10) == (0, 1)
+        with app.app_context():
+            notification = Notification.query.one()
+            assert notification.attempts == 1 and notification.sent_at is None
+            assert notification.last_error == "SMTP is down"
+            # retried after backoff
+            notification.next_attempt_at = None
+            db.session.commit()
+
+        FakeSMTP.connections = []
+        assert drain_outbox(EmailDispatcher(smtp_factory=FakeSMTP), 10) == (1, 1)
+        assert [msg["To"] for msg in FakeSMTP.connections[0].sent] == [TEST_FEED_BROKEN["owner_email"]]
+        assert drain_outbox(EmailDispatcher(smtp_factory=FakeSMTP), 10) == (0, 0)
+        with app.app_context():
+            assert Notification.query.one().sent_at is not None
+    finally:
+        with app.app_context():
+            db.drop_all()
+
+
+def test_host_circuit_breaker():
+    with app.app_context():
+        db.create_all()
+        down = [Feed(f"down {i}", f"https://down.example.com/{i}.xml") for i in range(6)]
+        up = Feed("up", "https://up.example.com/feed.xml")
+        db.session.add_all(down + [up])
+        db.session.commit()
+        down_ids = [feed.id for feed in down]
+    fetched = []
+
+    def fake_fetch(url, *args):
+        fetched.append(url)
+        if "down" in url:
+            raise requests.ConnectionError("Connection refused")
+        return feedparser.FeedParserDict(status=304, href=url, entries=[], etag=None, modified=None)
+
+    try:
+        with patch("worker.fetcher.fetch_feed", fake_fetch), \
+                patch.dict("worker.tasks.config", CIRCUIT_FAILURE_THRESHOLD=2, FETCH_PER_HOST_CONCURRENCY=1):
+            update_feeds()
+            # two failures open the circuit, the rest of the host's feeds aren't requested
+            assert sum("down" in url for url in fetched) == 2
+            with app.app_context():
+                health = db.session.get(HostHealth, "down.example.com")
+                assert health.consecutive_failures == 2 and health.opened_until > datetime.utcnow()
+                feeds = Feed.query.filter(Feed.id.in_(down_ids)).all()
+                assert sorted(feed.errors_count for feed in feeds) == [0, 0, 0, 0, 1, 1]
+                assert all(feed.next_retry_at > datetime.utcnow() for feed in feeds)
+                assert [feed.next_retry_at for feed in feeds if not feed.errors_count] == [health.opened_until] * 4
+                assert db.session.get(HostHealth, "up.example.com") is None
+
+            # nothing of the host is due while the circuit is open
+            fetched.clear()
+            update_feeds()
+            assert not [url for url in fetched if "down" in url]
+
+            # the first fetch after the circuit opening time is a probe, its failure opens the circuit again
+            with app.app_context():
+                Feed.query.update({Feed.next_retry_at: None, Feed.next_poll_at: None})
+                HostHealth.query.update({HostHealth.opened_until: datetime.utcnow() - timedelta(seconds=1)})
+                db.session.commit()
+            fetched.clear()
+            update_feeds()
+            assert sum("down" in url for url in fetched) == 1
+            with app.app_context():
+                assert db.session.get(HostHealth, "down.example.com").consecutive_failures == 3
+
+        # successful probe closes the circuit
+        with app.app_context():
+            Feed.query.update({Feed.next_retry_at: None, Feed.next_poll_at: None})
+            HostHealth.query.update({HostHealth.opened_until: datetime.utcnow() - timedelta(seconds=1)})
+            db.session.commit()
+        with patch("worker.fetcher.fetch_feed", lambda url, *args: fake_fetch(url.replace("down", "up"))):
+            update_feeds()
+        with app.app_context():
+            assert HostHealth.query.count() == 0
+    finally:
+        with app.app_context():
+            db.drop_all()
+
+
+def test_lease_renewal():
+    with app.app_context():
+        db.create_all()
+        db.session.add_all([Feed(f"slow {i}", f"https://slow.example.com/{i}.xml") for i in range(5)])
+        db.session.commit()
+    stolen = []
+
+    def slow_fetch(url, *args):
+        # another worker tries to claim while the batch is still being fetched
+        stolen.extend(feed.id for feed in Feed.claim_due("other worker", 100, 1))
+        time.sleep(0.4)
+        return feedparser.FeedParserDict(status=304, href=url, entries=[], etag=None, modified=None)
+
+    try:
+        # the batch (5 feeds one by one from the same host) takes twice as long as the lease
+        with patch("worker.fetcher.fetch_feed", slow_fetch), \
+                patch.dict("worker.tasks.config", FEED_LEASE_SEC=1, FETCH_PER_HOST_CONCURRENCY=1):
+            update_feeds()
+        assert stolen == []
+        with app.app_context():
+            assert Feed.query.filter(Feed.lease_owner.isnot(None)).count() == 0
+    finally:
+        with app.app_context():
+            db.drop_all()